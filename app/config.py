@@ -17,6 +17,34 @@ class Settings(BaseSettings):
     ML_SERVER_API_KEY: str
     MAIL: str
     MAIL_PASSWORD: str
+    REDIS_CONNECT_TIMEOUT: float = 1.0
+    REDIS_SOCKET_TIMEOUT: float = 0.5
+    REDIS_MAX_CONNECTIONS: int = 50
+    ML_CANCEL_ON_DISCONNECT: bool = False
+    # >1 coalesces concurrent /get-vector calls into batched /get-vectors requests,
+    # falling back to single calls if the ML server has no batch endpoint
+    ML_VECTOR_BATCH_SIZE: int = 16
+    ML_VECTOR_BATCH_MAX_WAIT_MS: float = 5.0
+    # Starting and maximum in-flight calls per ML endpoint group; adapts in between
+    ML_CONCURRENCY_INITIAL: int = 16
+    ML_CONCURRENCY_MAX: int = 128
+    # Hedge idempotent ML calls after this percentile of recent latency; 0 disables
+    ML_HEDGE_PERCENTILE: float = 95.0
+    ML_HEDGE_MIN_DELAY_MS: float = 50.0
+    # Hedges and retries may add at most this fraction of ML traffic
+    ML_RETRY_BUDGET_RATIO: float = 0.1
+    RATE_LIMIT_ALGORITHM: str = "gcra"
+    # Chat searches chunks of only this many nearest sources; 0 searches all
+    CHAT_TOP_SOURCES: int = 5
+    # Admin stats rollups: refreshed this often after writes, and at least every max age
+    ADMIN_STATS_REFRESH_SECONDS: int = 30
+    ADMIN_STATS_MAX_AGE_SECONDS: int = 900
+    # Analysis history keeps each user's newest entries; older ones are trimmed on this interval
+    ANALYSIS_HISTORY_KEEP: int = 100
+    ANALYSIS_HISTORY_TRIM_SECONDS: int = 3600
+    CACHE_NEAR_TTL: int = 30
+    CACHE_NEAR_MAX_ENTRIES: int = 10000
+    CACHE_NEAR_MAX_BYTES: int = 64 * 1024 * 1024
 
     model_config = SettingsConfigDict(env_file=".env")
 
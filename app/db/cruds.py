@@ -1,7 +1,11 @@
 import uuid
+from typing import Optional
+from datetime import datetime, timezone
+from sqlalchemy import update, select, func, delete
 from sqlalchemy.orm import Session
 from app.db.models import Source, AnalysisStatus
-from .models import Source, ResumeAnalysis, SourceChunk, AnalysisStatus, User, Conversation, ChatMessage
+from .models import Source, ResumeAnalysis, SourceChunk, AnalysisStatus, User, Conversation, ChatMessage, AnalysisHistory
+from app.services.admin_stats import bump_stat, mark_stale, CREDITS_SPENT, MESSAGES
 
 def create_file_record(db: Session, user_id: str, filename: str, s3_key: str = None, file_id=None, candidate_info: dict = None):
     db_record = ResumeAnalysis(
@@ -21,6 +25,7 @@ def create_file_record(db: Session, user_id: str, filename: str, s3_key: str = N
     except Exception as e:
         db.rollback()
         raise e
+    mark_stale()
     return db_record
 def update_file_record(db: Session, file_id: str, status: AnalysisStatus, score: float = None, details: dict = None, candidate_info: dict = None):
     if isinstance(file_id, str):
@@ -36,14 +41,102 @@ def update_file_record(db: Session, file_id: str, status: AnalysisStatus, score:
     if details is not None: db_record.details = details
     if candidate_info is not None: db_record.candidate_info = candidate_info
     if status == AnalysisStatus.COMPLETED:
-        user = db.query(User).filter(User.id == db_record.user_id).first()
-        if user and user.credits > 0:
-            user.credits -= 1
+        deduct_credits(db, db_record.user_id)
+        append_history(db, db_record.user_id, [db_record])
 
     db.commit()
     db.refresh(db_record)
+    mark_stale()
     return db_record
 
+def append_history(db: Session, user_id: uuid.UUID, analyses: list):
+    """Log processed analyses (anything with filename/match_score/id); the caller commits."""
+    db.add_all([
+        AnalysisHistory(
+            user_id=user_id,
+            filename=a.filename,
+            match_score=a.match_score,
+            analysis_id=a.id,
+        )
+        for a in analyses
+    ])
+
+def trim_analysis_history(db: Session, keep: int, batch_size: int = 10000) -> int:
+    """Delete up to `batch_size` entries beyond each user's newest `keep`; returns how many went."""
+    ranked = select(
+        AnalysisHistory.id,
+        func.row_number().over(
+            partition_by=AnalysisHistory.user_id,
+            order_by=(AnalysisHistory.created_at.desc(), AnalysisHistory.id.desc()),
+        ).label("rank"),
+    ).subquery()
+    expired = select(ranked.c.id).where(ranked.c.rank > keep).limit(batch_size)
+    result = db.execute(delete(AnalysisHistory).where(AnalysisHistory.id.in_(expired)))
+    db.commit()
+    return result.rowcount
+
+def delete_file_records(db: Session, user_id: uuid.UUID) -> list:
+    """Delete all of a user's analyses in one statement; returns their S3 keys. The caller commits."""
+    return db.execute(
+        delete(ResumeAnalysis)
+        .where(ResumeAnalysis.user_id == user_id)
+        .returning(ResumeAnalysis.s3_key)
+    ).scalars().all()
+
+def search_analyses(
+        db: Session,
+        user_id: uuid.UUID,
+        statuses: Optional[list] = None,
+        min_score: Optional[float] = None,
+        max_score: Optional[float] = None,
+        candidate_filters: Optional[dict] = None,
+        limit: int = 20,
+        include_details: bool = False
+    ) -> list:
+    """
+    Top `limit` analyses by match_score matching every given filter.
+    `candidate_filters` is matched with JSONB containment (@>), so it is
+    served by the GIN index on candidate_info. The JSONB columns are only
+    read when `include_details` is set.
+    """
+    columns = [
+        ResumeAnalysis.id, ResumeAnalysis.status, ResumeAnalysis.filename,
+        ResumeAnalysis.created_at, ResumeAnalysis.match_score,
+    ]
+    if include_details:
+        columns += [ResumeAnalysis.details, ResumeAnalysis.candidate_info]
+    query = db.query(*columns).filter(ResumeAnalysis.user_id == user_id)
+    if statuses:
+        query = query.filter(ResumeAnalysis.status.in_(statuses))
+    if min_score is not None:
+        query = query.filter(ResumeAnalysis.match_score >= min_score)
+    if max_score is not None:
+        query = query.filter(ResumeAnalysis.match_score <= max_score)
+    if candidate_filters:
+        query = query.filter(ResumeAnalysis.candidate_info.contains(candidate_filters))
+    return (
+        query
+        .order_by(ResumeAnalysis.match_score.desc().nullslast(), ResumeAnalysis.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+def deduct_credits(db: Session, user_id, amount: int = 1) -> Optional[int]:
+    """
+    Take `amount` credits in a single conditional UPDATE (no row load).
+    Returns the new balance, or None if the user can't afford it; the caller commits.
+    """
+    balance = db.execute(
+        update(User)
+        .where(User.id == user_id, User.credits >= amount)
+        .values(credits=User.credits - amount)
+        .returning(User.credits)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+    if balance is not None:
+        bump_stat(db, CREDITS_SPENT, amount)
+    return balance
+
 def create_source_record(db: Session, user_id: uuid.UUID, source_name: str, unique_key: str, source_type: str = "video"):
     db_source = Source(
         id=uuid.uuid4(),
@@ -57,6 +150,7 @@ def create_source_record(db: Session, user_id: uuid.UUID, source_name: str, uniq
     try:
         db.commit()
         db.refresh(db_source)
+        mark_stale()
         return db_source
     except Exception as e:
         db.rollback()
@@ -81,6 +175,7 @@ def update_source_status(db: Session, source_id: str, status: str):
 
         db.commit()
         db.refresh(db_record)
+        mark_stale()
         return db_record
     except Exception as e:
         db.rollback()
@@ -89,9 +184,11 @@ def update_source_status(db: Session, source_id: str, status: str):
 
 def add_source_chunks(db: Session, source_id: uuid.UUID, chunks_data: list):
     try:
+        user_id = db.query(Source.user_id).filter(Source.id == source_id).scalar()
         for data in chunks_data:
             chunk = SourceChunk(
                 source_id=source_id,
+                user_id=user_id,
                 content=data['content'],
                 embedding=data['embedding'],
                 status='completed'
@@ -99,12 +196,25 @@ def add_source_chunks(db: Session, source_id: uuid.UUID, chunks_data: list):
             db.add(chunk)
         
         db.query(Source).filter(Source.id == source_id).update({"status": AnalysisStatus.COMPLETED})
+        refresh_source_embedding(db, source_id, user_id)
         db.commit()
+        mark_stale()
     except Exception as e:
         db.rollback()
         db.query(Source).filter(Source.id == source_id).update({"status": AnalysisStatus.FAILED})
         db.commit()
         raise e
+def refresh_source_embedding(db: Session, source_id: uuid.UUID, user_id: uuid.UUID):
+    """Set the source's summary embedding to the centroid of its chunks; the caller commits."""
+    db.flush()
+    centroid = (
+        select(func.avg(SourceChunk.embedding))
+        .where(SourceChunk.user_id == user_id, SourceChunk.source_id == source_id)
+        .scalar_subquery()
+    )
+    db.query(Source).filter(Source.id == source_id).update(
+        {Source.embedding: centroid}, synchronize_session=False
+    )
 def get_source_by_id(db: Session, source_id: uuid.UUID):
     return db.query(Source).filter(Source.id == source_id).first()
 
@@ -135,6 +245,7 @@ def get_or_create_source(
         db.add(new_source)
         db.commit()
         db.refresh(new_source)
+        mark_stale()
         
         return new_source.id, False
 
@@ -159,6 +270,84 @@ def save_message(db: Session, conversation_id: uuid.UUID, role: str, content: st
     db.commit()
     db.refresh(new_msg)
     return new_msg
+def find_conversation_id(db: Session, conversation_id: Optional[uuid.UUID], user_id: uuid.UUID) -> Optional[uuid.UUID]:
+    """Return the id if the conversation belongs to the user; ends the read transaction."""
+    try:
+        if conversation_id is None:
+            return None
+        return db.query(Conversation.id).filter(
+            Conversation.id == conversation_id,
+            Conversation.user_id == user_id
+        ).scalar()
+    finally:
+        db.rollback()
+def search_chunk_contents(
+        db: Session,
+        user_id: uuid.UUID,
+        query_vector: list,
+        limit: int = 5,
+        top_sources: int = 5,
+        source_ids: Optional[list] = None
+    ) -> list:
+    """
+    Nearest chunks across the user's sources; ends the read transaction.
+    Only the user's chunk partition is scanned. `source_ids` restricts the
+    search to those sources; otherwise, with `top_sources`, only chunks of the
+    sources whose centroids are nearest the query are ranked, so cost doesn't
+    grow with the size of the library. Sources and chunks are ranked by exact
+    scans of the user's rows, so searches never come back short.
+    """
+    try:
+        query = db.query(SourceChunk.content).filter(SourceChunk.user_id == user_id)
+        if source_ids:
+            query = query.filter(SourceChunk.source_id.in_(source_ids))
+        elif top_sources:
+            nearest_sources = (
+                select(Source.id)
+                .where(Source.user_id == user_id, Source.embedding.isnot(None))
+                .order_by(Source.embedding.cosine_distance(query_vector))
+                .limit(top_sources)
+            )
+            query = query.filter(SourceChunk.source_id.in_(nearest_sources))
+        rows = (
+            query
+            .order_by(SourceChunk.embedding.cosine_distance(query_vector))
+            .limit(limit)
+            .all()
+        )
+        return [content for (content,) in rows]
+    finally:
+        db.rollback()
+def save_chat_exchange(
+        db: Session,
+        user_id: uuid.UUID,
+        conversation_id: Optional[uuid.UUID],
+        title: str,
+        question: str,
+        answer: str,
+        asked_at: datetime
+    ) -> Optional[uuid.UUID]:
+    """
+    Persist both messages, the conversation if new, and the credit in one transaction.
+    Returns the conversation id, or None (nothing written) if the user is out of credits.
+    """
+    if conversation_id is None:
+        conversation_id = uuid.uuid4()
+        db.add(Conversation(id=conversation_id, title=title, user_id=user_id))
+    db.add_all([
+        ChatMessage(conversation_id=conversation_id, role="user", content=question, created_at=asked_at),
+        ChatMessage(conversation_id=conversation_id, role="assistant", content=answer, created_at=datetime.now(timezone.utc)),
+    ])
+    try:
+        if deduct_credits(db, user_id) is None:
+            db.rollback()
+            return None
+        bump_stat(db, MESSAGES, 2)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+    return conversation_id
 def get_chat_history(db: Session, conversation_id: uuid.UUID, limit: int = 20):
     return db.query(ChatMessage)\
              .filter(ChatMessage.conversation_id == conversation_id)\
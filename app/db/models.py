@@ -1,10 +1,10 @@
 import uuid, enum
 from .connect import Base
-from sqlalchemy import Text
+from sqlalchemy import Text, DDL, event
 from pgvector.sqlalchemy import Vector
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.dialects.postgresql import UUID, JSONB
-from sqlalchemy import Column, String, DateTime, func, ForeignKey, Float, Enum, Integer
+from sqlalchemy import Column, String, DateTime, func, ForeignKey, Float, Enum, Integer, Date, SmallInteger, BigInteger, Index
 
 
 class AnalysisStatus(enum.Enum):
@@ -30,7 +30,6 @@ class User(Base):
     role = Column(Enum(UserRole), default=UserRole.USER)
     hashed_password = Column(String, nullable=False)
     linked_folder_ids = Column(JSONB, nullable=True)
-    processed_filenames = Column(JSONB, nullable=True)
     email = Column(String, unique=True, nullable=False)
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     updated_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -52,6 +51,18 @@ class ResumeAnalysis(Base):
     updated_at = Column(DateTime(timezone=True), onupdate=func.now(), server_default=func.now())
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
 
+class AnalysisHistory(Base):
+    """Append-only log of processed files; trimmed per user in the background, never updated."""
+    __tablename__ = "analysis_history"
+    __table_args__ = (Index("ix_analysis_history_user_created", "user_id", "created_at", "id"),)
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    filename = Column(String, nullable=False)
+    match_score = Column(Float, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    # Kept after the analysis itself is reset
+    analysis_id = Column(UUID(as_uuid=True), ForeignKey("resume_analyses.id", ondelete="SET NULL"), nullable=True)
+
 class Source(Base):
     __tablename__ = "sources"
     source_name = Column(String, nullable=False)
@@ -60,19 +71,33 @@ class Source(Base):
     unique_key = Column(String, unique=True, nullable=False)
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     status = Column(Enum(AnalysisStatus), default=AnalysisStatus.PENDING)
+    # Centroid of the chunk embeddings, used to route chat retrieval
+    embedding = deferred(Column(Vector(768), nullable=True))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     chunks = relationship("SourceChunk", back_populates="source", cascade="all, delete-orphan")
     updated_at = Column(DateTime(timezone=True), onupdate=func.now(), server_default=func.now())
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
 
+SOURCE_CHUNK_PARTITIONS = 16
+
 class SourceChunk(Base):
     __tablename__ = "source_chunks"
+    # Hash partitioned by owner so a user's vector search scans one partition
+    __table_args__ = {"postgresql_partition_by": "HASH (user_id)"}
     embedding = Column(Vector(768)) 
     content = Column(Text, nullable=False)
     status = Column(Enum(AnalysisStatus), default=AnalysisStatus.PENDING)
     source = relationship("Source", back_populates="chunks")
     id = Column(Integer, primary_key=True, autoincrement=True)
     source_id = Column(UUID(as_uuid=True), ForeignKey("sources.id", ondelete="CASCADE"), nullable=False)
+    # Denormalized from Source; part of the key because it is the partition key
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+
+for remainder in range(SOURCE_CHUNK_PARTITIONS):
+    event.listen(SourceChunk.__table__, "after_create", DDL(
+        f"CREATE TABLE IF NOT EXISTS source_chunks_p{remainder} PARTITION OF source_chunks "
+        f"FOR VALUES WITH (MODULUS {SOURCE_CHUNK_PARTITIONS}, REMAINDER {remainder})"
+    ).execute_if(dialect="postgresql"))
 
 class Conversation(Base):
     __tablename__ = "conversations"
@@ -99,5 +124,42 @@ class Feedback(Base):
     category = Column(Enum(Category), default=Category.GENERAL)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    
-    
\ No newline at end of file
+
+class StatCounter(Base):
+    """Daily event counters for admin stats, split into shards so concurrent writers rarely share a row."""
+    __tablename__ = "stat_counters"
+    metric = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    shard = Column(SmallInteger, primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+# Rollups of current state for admin stats, refreshed in the background. Each
+# needs a unique index so it can be refreshed CONCURRENTLY while being read.
+ADMIN_STATS_VIEWS = {
+    "admin_stats_users": (
+        "SELECT 1 AS id, count(*) AS users, count(*) FILTER (WHERE role = 'ADMIN') AS admins, "
+        "COALESCE(sum(credits), 0) AS credits_outstanding FROM users",
+        "id",
+    ),
+    "admin_stats_sources": (
+        "SELECT COALESCE(lower(status::text), 'unknown') AS status, source_type, count(*) AS count "
+        "FROM sources GROUP BY 1, 2",
+        "status, source_type",
+    ),
+    "admin_stats_analyses": (
+        "SELECT COALESCE(lower(status::text), 'unknown') AS status, "
+        "(LEAST(GREATEST(floor(COALESCE(match_score, 0) / 10), 0), 9) * 10)::int AS score_band, "
+        "count(*) AS count FROM resume_analyses GROUP BY 1, 2",
+        "status, score_band",
+    ),
+}
+
+def admin_stats_view_ddl() -> list:
+    statements = []
+    for name, (query, key) in ADMIN_STATS_VIEWS.items():
+        statements.append(f"CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {query}")
+        statements.append(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{name}_key ON {name} ({key})")
+    return statements
+
+for statement in admin_stats_view_ddl():
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect="postgresql"))
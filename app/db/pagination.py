@@ -0,0 +1,46 @@
+"""
+Keyset pagination on (created_at, id)
+
+Pages are fetched with a row comparison against the last row of the previous
+page, so every page costs one index range scan no matter how deep it is.
+Cursors are opaque base64 strings; clients only pass them back.
+"""
+import uuid
+import base64
+from datetime import datetime
+from typing import Optional, Tuple
+from sqlalchemy import tuple_, literal
+from sqlalchemy.orm import Query
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(created_at: datetime, row_id: uuid.UUID) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    """Raises ValueError for anything that isn't a cursor we issued."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.split("|")
+        return datetime.fromisoformat(created_at), uuid.UUID(row_id)
+    except (TypeError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def paginate(query: Query, created_col, id_col, cursor: Optional[str], limit: int, ascending: bool = False):
+    """Return (rows, next_cursor); next_cursor is None on the last page."""
+    key = tuple_(created_col, id_col)
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        after = tuple_(literal(created_at, created_col.type), literal(row_id, id_col.type))
+        query = query.filter(key > after if ascending else key < after)
+    order = (created_col.asc(), id_col.asc()) if ascending else (created_col.desc(), id_col.desc())
+    rows = query.order_by(*order).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(getattr(last, created_col.key), getattr(last, id_col.key))
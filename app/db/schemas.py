@@ -2,7 +2,7 @@ from uuid import UUID
 from datetime import datetime
 from typing import List, Optional, Literal
 from pydantic import BaseModel, EmailStr, ConfigDict
-from app.db.models import Category
+from app.db.models import Category, UserRole
 
 class UserBaseSchema(BaseModel):
     email: EmailStr
@@ -12,6 +12,15 @@ class FolderDataSchema(BaseModel):
     googleToken: str
     description: str
 
+class PrincipalSchema(BaseModel):
+    """Serializable snapshot of the authenticated user, cached between requests."""
+    id: UUID
+    email: str
+    role: UserRole = UserRole.USER
+    credits: int = 0
+    updated_at: Optional[datetime] = None
+    model_config = ConfigDict(from_attributes=True)
+
 class UserCreateSchema(UserBaseSchema):
     password: str
 
@@ -35,7 +44,6 @@ class UserResponseSchema(UserBaseSchema):
     updated_at: datetime
     role: Literal["user", "admin"] = "user"
     linked_folder_ids: List[str] = []
-    processed_filenames: List[str] = []
     analyses: List[AnalysisResponseSchema] = []
     model_config = ConfigDict(from_attributes=True)
 
@@ -53,6 +61,8 @@ class StatusUpdateSchema(BaseModel):
 class ChatRequestSchema(BaseModel):
     question: str
     conversation_id: Optional[str] = None
+    # Restrict retrieval to these sources instead of the nearest ones
+    source_ids: Optional[List[UUID]] = None
 
 class ChunkDataSchema(BaseModel):
     content: str
@@ -72,6 +82,22 @@ class SourceSchema(BaseModel):
     source_type: str
     status: str
     created_at: datetime
+    model_config = ConfigDict(from_attributes=True)
+
+class ConversationSchema(BaseModel):
+    id: UUID
+    user_id: UUID
+    title: Optional[str] = None
+    created_at: datetime
+    model_config = ConfigDict(from_attributes=True)
+
+class ChatMessageSchema(BaseModel):
+    id: UUID
+    conversation_id: UUID
+    role: str
+    content: str
+    created_at: datetime
+    model_config = ConfigDict(from_attributes=True)
 
 class FeedbackSchema(BaseModel):
     email: EmailStr
@@ -1,24 +1,62 @@
 import jwt
 import bcrypt
+import hashlib
+import threading
+from time import time
+from collections import OrderedDict
+from typing import Optional
+from pydantic import ValidationError
+from app.lib import cache
 from app.config import settings
+from app.db.schemas import PrincipalSchema
 from datetime import datetime, timedelta
 
 app_settings = settings()
 
+# Bump whenever PrincipalSchema changes shape so stale snapshots are ignored
+PRINCIPAL_CACHE_VERSION = 1
+PRINCIPAL_CACHE_TTL = 300
+
+# Verified claims keyed by token digest; entries live until the earlier of
+# the token's exp and TOKEN_CACHE_TTL.
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300
+_verified_tokens: "OrderedDict[bytes, tuple]" = OrderedDict()
+_verified_tokens_lock = threading.Lock()
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(hours=24)
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, app_settings.SECRET_KEY, algorithm=app_settings.ALGORITHM)
 
+def _token_digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
 def decode_token(token: str):
+    """Verify a JWT, serving repeat tokens from the in-process claims cache."""
+    digest = _token_digest(token)
+    now = time()
+    with _verified_tokens_lock:
+        entry = _verified_tokens.get(digest)
+        if entry is not None:
+            expires_at, payload = entry
+            if expires_at > now:
+                _verified_tokens.move_to_end(digest)
+                return payload
+            del _verified_tokens[digest]
     try:
         payload = jwt.decode(token, app_settings.SECRET_KEY, algorithms=[app_settings.ALGORITHM])
-        return payload
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
+    expires_at = min(payload.get("exp", now), now + TOKEN_CACHE_TTL)
+    with _verified_tokens_lock:
+        _verified_tokens[digest] = (expires_at, payload)
+        while len(_verified_tokens) > TOKEN_CACHE_SIZE:
+            _verified_tokens.popitem(last=False)
+    return payload
 
 def hash_password(password: str) -> str:
     pwd_bytes = password.encode('utf-8')
@@ -30,4 +68,27 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(
         plain_password.encode('utf-8'), 
         hashed_password.encode('utf-8')
-    )
\ No newline at end of file
+    )
+
+def principal_cache_key(email: str) -> str:
+    return f"principal:v{PRINCIPAL_CACHE_VERSION}:{email}"
+
+async def get_cached_principal(email: str) -> Optional[PrincipalSchema]:
+    cached = await cache.get(principal_cache_key(email))
+    if not cached:
+        return None
+    try:
+        return PrincipalSchema.model_validate(cached)
+    except ValidationError:
+        await cache.delete(principal_cache_key(email))
+        return None
+
+async def cache_principal(user) -> PrincipalSchema:
+    principal = PrincipalSchema.model_validate(user)
+    await cache.set(
+        principal_cache_key(principal.email),
+        principal.model_dump(mode="json"),
+        ttl=PRINCIPAL_CACHE_TTL,
+        tags=[f"user:{principal.id}"],
+    )
+    return principal
@@ -2,10 +2,15 @@ import io
 import uuid
 import os
 import boto3
+import logging
 from app.config import settings
 from botocore.config import Config
 
 get_settings = settings()
+logger = logging.getLogger(__name__)
+
+# DeleteObjects accepts at most 1000 keys per request
+S3_DELETE_BATCH = 1000
 
 s3_client = boto3.client(
     's3',
@@ -40,4 +45,23 @@ def get_secure_url(s3_key: str):
         'get_object',
         Params={'Bucket': get_settings.AWS_BUCKET_NAME, 'Key': s3_key},
         ExpiresIn=900
-    )
\ No newline at end of file
+    )
+
+def delete_s3_objects(keys: list) -> list:
+    """Delete keys with batched DeleteObjects calls; returns the keys that couldn't be deleted."""
+    keys = [key for key in keys if key]
+    failed = []
+    for i in range(0, len(keys), S3_DELETE_BATCH):
+        batch = keys[i:i + S3_DELETE_BATCH]
+        try:
+            resp = s3_client.delete_objects(
+                Bucket=get_settings.AWS_BUCKET_NAME,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            )
+            failed += [error["Key"] for error in resp.get("Errors", [])]
+        except Exception as e:
+            logger.error(f"S3 batch delete failed: {e}")
+            failed += batch
+    if failed:
+        logger.warning(f"{len(failed)} of {len(keys)} S3 objects were not deleted")
+    return failed
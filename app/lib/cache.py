@@ -1,46 +1,186 @@
 """
 Redis caching utility for API responses and database queries
+
+All Redis traffic uses the shared asyncio client from ``redis_pool`` so a slow
+Redis delays only the awaiting request, never the event loop. Reads go
+through a bounded in-process LRU (the "near cache") before Redis. Deletes are
+broadcast over Redis pub/sub so other workers drop their near copies too.
+Without Redis the LRU is the only tier and honours full TTLs.
+
+Entries can be registered under tags (``user:{id}``, ``conversation:{id}``)
+so that everything derived from one record is dropped with ``invalidate_tag``.
+Each tag also has a version token that ``invalidate_tag`` replaces, so
+callers can tell whether anything under a tag has changed (e.g. for ETags).
 """
 import json
+import math
+import uuid
+import base64
+import random
+import asyncio
+import inspect
 import hashlib
-from typing import Optional, Any
+import logging
+import builtins
+import threading
+from time import monotonic, time
+from collections import OrderedDict
+from typing import Optional, Any, Tuple, Dict, Callable, Iterable
 from functools import wraps
-from fastapi import Request
-import redis
+from fastapi import Request, Response
+from pydantic import TypeAdapter
 from app.config import settings
+from app.lib.redis_pool import get_redis
+from app.lib.compression import MINIMUM_SIZE, compress_variants, decompress, negotiate
 
 get_settings = settings()
+logger = logging.getLogger(__name__)
 
+INVALIDATION_CHANNEL = "cache:invalidate"
+TAG_PREFIX = "tag:"
+TAG_TTL = 24 * 60 * 60
+VERSION_PREFIX = "ver:"
+
+# KEYS are ARGV[1] tag sets followed by their version keys. Deletes every key
+# registered under the tag sets, then the sets, replaces the versions with
+# ARGV[2], and returns the changed keys so they can be evicted from near caches.
+_INVALIDATE_TAGS_LUA = """
+local n = tonumber(ARGV[1])
+local keys = redis.call('SUNION', unpack(KEYS, 1, n))
+for i = 1, #keys, 1000 do
+    redis.call('DEL', unpack(keys, i, math.min(i + 999, #keys)))
+end
+redis.call('DEL', unpack(KEYS, 1, n))
+for i = n + 1, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[2], 'EX', ARGV[3])
+    keys[#keys + 1] = KEYS[i]
+end
+return keys
+"""
+
+# Loads currently running in this process, keyed by cache key
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+class LRUCache:
+    """Size-bounded in-process LRU with per-entry TTL; values are stored serialized."""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, Tuple[float, str, Tuple[str, ...]]]" = OrderedDict()
+        self._tags: Dict[str, builtins.set] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, raw, _ = entry
+            if expires_at <= monotonic():
+                self._pop(key)
+                return None
+            self._data.move_to_end(key)
+            return raw
+
+    def set(self, key: str, raw: str, ttl: int, tags: Tuple[str, ...] = ()):
+        with self._lock:
+            self._pop(key)
+            if ttl <= 0 or len(raw) > self.max_bytes:
+                return
+            self._data[key] = (monotonic() + ttl, raw, tags)
+            self._bytes += len(raw)
+            for tag in tags:
+                self._tags.setdefault(tag, builtins.set()).add(key)
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._pop(next(iter(self._data)))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._pop(key)
+
+    def delete_tag(self, tag: str):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def _pop(self, key: str):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= len(entry[1])
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
 
-def _make_redis_client():
-    """Create Redis client from REDIS_URL or REDIS_HOST/PORT/DB."""
-    if get_settings.REDIS_URL:
-        # Use full URL (supports redis:// and rediss:// for TLS)
-        return redis.from_url(
-            get_settings.REDIS_URL,
-            decode_responses=True,
-            socket_connect_timeout=5,
-            socket_timeout=5,
-        )
-    return redis.Redis(
-        host=get_settings.REDIS_HOST,
-        port=get_settings.REDIS_PORT,
-        db=get_settings.REDIS_DB,
-        decode_responses=True,
-        socket_connect_timeout=5,
-        socket_timeout=5,
-    )
-
-
-# Initialize Redis client (with fallback to in-memory cache if Redis unavailable)
-try:
-    redis_client = _make_redis_client()
-    redis_client.ping()
-    REDIS_AVAILABLE = True
-except Exception as e:
-    REDIS_AVAILABLE = False
-    _memory_cache = {}
-    print(f"Redis not available, using in-memory cache: {e}")
+
+_near_cache = LRUCache(
+    max_entries=get_settings.CACHE_NEAR_MAX_ENTRIES,
+    max_bytes=get_settings.CACHE_NEAR_MAX_BYTES,
+)
+
+_invalidation_listener: Optional[asyncio.Task] = None
+
+
+async def _listen_for_invalidations(pubsub):
+    """Drop near-cache entries deleted by any worker."""
+    try:
+        while True:
+            try:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener error: {e}")
+                await asyncio.sleep(1.0)
+                continue
+            if not message:
+                continue
+            try:
+                keys = json.loads(message["data"])
+            except (TypeError, ValueError):
+                continue
+            for key in keys:
+                _near_cache.delete(key)
+    finally:
+        await pubsub.aclose()
+
+
+async def start_invalidation_listener():
+    """Subscribe this worker's near cache to cross-worker deletes."""
+    global _invalidation_listener
+    redis_client = get_redis()
+    if redis_client is None or _invalidation_listener is not None:
+        return
+    try:
+        pubsub = redis_client.pubsub()
+        await pubsub.subscribe(INVALIDATION_CHANNEL)
+    except Exception as e:
+        logger.warning(f"Cache invalidation listener not started: {e}")
+        return
+    _invalidation_listener = asyncio.create_task(_listen_for_invalidations(pubsub))
+
+
+async def stop_invalidation_listener():
+    global _invalidation_listener
+    if _invalidation_listener is not None:
+        _invalidation_listener.cancel()
+        try:
+            await _invalidation_listener
+        except asyncio.CancelledError:
+            pass
+        _invalidation_listener = None
 
 
 def get_cache_key(request: Request, prefix: str = "api", user_id: str = None) -> str:
@@ -53,77 +193,292 @@ def get_cache_key(request: Request, prefix: str = "api", user_id: str = None) ->
     return f"{prefix}:{key_hash}"
 
 
-def get(key: str) -> Optional[Any]:
+async def get(key: str) -> Optional[Any]:
     """Get value from cache"""
-    if REDIS_AVAILABLE:
+    raw = _near_cache.get(key)
+    redis_client = get_redis()
+    if raw is None and redis_client is not None:
         try:
-            value = redis_client.get(key)
-            return json.loads(value) if value else None
+            raw = await redis_client.get(key)
         except Exception:
             return None
-    else:
-        return _memory_cache.get(key)
+        if raw is not None:
+            _near_cache.set(key, raw, get_settings.CACHE_NEAR_TTL)
+    return json.loads(raw) if raw else None
 
 
-def set(key: str, value: Any, ttl: int = 300) -> bool:
-    """Set value in cache with TTL"""
-    if REDIS_AVAILABLE:
-        try:
-            redis_client.setex(key, ttl, json.dumps(value))
-            return True
-        except Exception:
-            return False
-    else:
-        _memory_cache[key] = value
+async def set(key: str, value: Any, ttl: int = 300, tags: Iterable[str] = ()) -> bool:
+    """Set value in cache with TTL, registering the key under each tag"""
+    try:
+        raw = json.dumps(value)
+    except (TypeError, ValueError):
+        return False
+    tags = tuple(tags)
+    redis_client = get_redis()
+    if redis_client is None:
+        _near_cache.set(key, raw, ttl, tags)
         return True
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.setex(key, ttl, raw)
+            for tag in tags:
+                pipe.sadd(TAG_PREFIX + tag, key)
+                pipe.expire(TAG_PREFIX + tag, max(ttl, TAG_TTL))
+            await pipe.execute()
+    except Exception:
+        return False
+    _near_cache.set(key, raw, min(ttl, get_settings.CACHE_NEAR_TTL))
+    return True
 
 
-def delete(key: str) -> bool:
+async def delete(key: str) -> bool:
     """Delete key from cache"""
-    if REDIS_AVAILABLE:
+    _near_cache.delete(key)
+    redis_client = get_redis()
+    if redis_client is None:
+        return True
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.delete(key)
+            pipe.publish(INVALIDATION_CHANNEL, json.dumps([key]))
+            await pipe.execute()
+    except Exception:
+        return False
+    return True
+
+
+def _new_version() -> str:
+    # Random rather than a counter so an expired version can never come back
+    return uuid.uuid4().hex
+
+
+async def invalidate_tag(*tags: str) -> bool:
+    """Delete every key registered under the given tags and bump their versions in one round trip"""
+    if not tags:
+        return True
+    version = _new_version()
+    redis_client = get_redis()
+    if redis_client is None:
+        for tag in tags:
+            _near_cache.delete_tag(tag)
+            _near_cache.set(VERSION_PREFIX + tag, version, TAG_TTL)
+        return True
+    try:
+        script = redis_client.register_script(_INVALIDATE_TAGS_LUA)
+        keys = await script(
+            keys=[TAG_PREFIX + tag for tag in tags] + [VERSION_PREFIX + tag for tag in tags],
+            args=[len(tags), version, TAG_TTL],
+        )
+    except Exception:
+        return False
+    for key in keys:
+        _near_cache.delete(key)
+    if keys:
         try:
-            redis_client.delete(key)
-            return True
+            await redis_client.publish(INVALIDATION_CHANNEL, json.dumps(keys))
         except Exception:
-            return False
-    else:
-        _memory_cache.pop(key, None)
+            pass
+    return True
+
+
+async def tag_version(tag: str) -> Optional[str]:
+    """
+    Opaque token that changes whenever ``invalidate_tag`` is called for `tag`
+
+    Created on first use. None if Redis can't be reached, in which case
+    callers should assume the data has changed.
+    """
+    key = VERSION_PREFIX + tag
+    version = _near_cache.get(key)
+    if version is not None:
+        return version
+    redis_client = get_redis()
+    if redis_client is None:
+        version = _new_version()
+        _near_cache.set(key, version, TAG_TTL)
+        return version
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(key, _new_version(), ex=TAG_TTL, nx=True)
+            pipe.get(key)
+            _, version = await pipe.execute()
+    except Exception:
+        return None
+    _near_cache.set(key, version, get_settings.CACHE_NEAR_TTL)
+    return version
+
+
+def _should_refresh(envelope: dict, now: float, beta: float) -> bool:
+    """XFetch: past expiry, or probabilistically earlier the slower the load was."""
+    expires_at = envelope.get("expires_at", 0)
+    if now >= expires_at:
         return True
+    if beta <= 0:
+        return False
+    jitter = -envelope.get("delta", 0) * beta * math.log(1.0 - random.random())
+    return now + jitter >= expires_at
+
+
+async def _load(key: str, loader: Callable[[], Any], ttl: int, stale_ttl: int, tags: Tuple[str, ...], lock=None):
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        started = monotonic()
+        value = loader()
+        if inspect.isawaitable(value):
+            value = await value
+        envelope = {"value": value, "expires_at": time() + ttl, "delta": monotonic() - started}
+        await set(key, envelope, ttl + stale_ttl, tags)
+        future.set_result(value)
+        return value
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # waiters re-raise it; don't warn if there were none
+        raise
+    finally:
+        _inflight.pop(key, None)
+        if lock is not None:
+            try:
+                await lock.release()
+            except Exception:
+                pass
+
+
+async def _try_lock(key: str, timeout: float):
+    """Cross-worker loader lock; returns (acquired, lock)."""
+    redis_client = get_redis()
+    if redis_client is None:
+        return True, None
+    try:
+        lock = redis_client.lock(f"lock:{key}", timeout=timeout, blocking=False)
+        return await lock.acquire(), lock
+    except Exception:
+        return True, None
 
 
-def cache_response(ttl: int = 300, key_prefix: str = "api"):
-    """Decorator to cache API responses"""
+async def get_or_load(
+    key: str,
+    loader: Callable[[], Any],
+    ttl: int = 300,
+    stale_ttl: int = 60,
+    early_refresh: float = 1.0,
+    lock_timeout: float = 10.0,
+    wait_timeout: float = 2.0,
+    tags: Iterable[str] = (),
+) -> Any:
+    """
+    Read-through cache with single-flight loading and stale-while-revalidate
+
+    Only one caller per key runs ``loader`` (per process via a shared future,
+    across workers via a Redis lock). While it runs, callers holding a stale
+    copy get that copy and the rest wait for the result. Entries stay readable
+    for ``stale_ttl`` seconds past ``ttl``; ``early_refresh`` is the XFetch beta
+    (0 disables refreshing before expiry).
+    """
+    tags = tuple(tags)
+    envelope = await get(key)
+    if isinstance(envelope, dict) and "value" in envelope:
+        if not _should_refresh(envelope, time(), early_refresh):
+            return envelope["value"]
+        if key in _inflight:
+            return envelope["value"]
+        acquired, lock = await _try_lock(key, lock_timeout)
+        if not acquired:
+            return envelope["value"]
+        return await _load(key, loader, ttl, stale_ttl, tags, lock)
+
+    if key in _inflight:
+        return await asyncio.shield(_inflight[key])
+
+    acquired, lock = await _try_lock(key, lock_timeout)
+    if not acquired:
+        # Another worker is loading; give it a moment to publish the value
+        deadline = monotonic() + wait_timeout
+        while monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            envelope = await get(key)
+            if isinstance(envelope, dict) and "value" in envelope:
+                return envelope["value"]
+        if key in _inflight:
+            return await asyncio.shield(_inflight[key])
+        lock = None
+    return await _load(key, loader, ttl, stale_ttl, tags, lock)
+
+
+def cache_response(
+    response_model: Any,
+    ttl: int = 300,
+    stale_ttl: int = 60,
+    key_prefix: str = "api",
+    user_param: str = "current_user",
+    tags: Optional[Callable[..., Iterable[str]]] = None,
+    headers: Iterable[str] = ("X-Next-Cursor",),
+):
+    """
+    Cache a route's serialized JSON body through ``get_or_load``
+
+    The route's return value (ORM objects are fine) is validated against
+    `response_model` and encoded once by pydantic-core on a miss; hits return
+    the stored body as a raw ``Response`` with no validation or encoding.
+    Bodies of at least ``MINIMUM_SIZE`` bytes are stored only in compressed
+    forms (see ``compress_variants``) and served in whichever one the
+    client's Accept-Encoding prefers, so hits never compress. The key covers
+    method, path, query and the user in `user_param`, and entries are tagged
+    ``user:{id}`` unless `tags` (called with the route's kwargs) says
+    otherwise. Listed `headers` the route sets are stored with the body;
+    headers set by dependencies (e.g. ETag) are passed through. The route
+    must take ``request`` and ``response`` parameters.
+    """
+    adapter = TypeAdapter(response_model)
+    headers = tuple(headers)
+
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            # Try to get request from kwargs
-            request = kwargs.get('request') or (args[0] if args and hasattr(args[0], 'url') else None)
-            
-            if not request:
-                return await func(*args, **kwargs)
-            
-            cache_key = get_cache_key(request, key_prefix)
-            cached = get(cache_key)
-            
-            if cached:
-                return cached
-            
-            result = await func(*args, **kwargs)
-            set(cache_key, result, ttl)
-            return result
-        return wrapper
-    return decorator
+            request: Request = kwargs["request"]
+            response: Response = kwargs["response"]
+            user = kwargs.get(user_param)
+            user_id = str(user.id) if user is not None else None
+            key_tags = tuple(tags(**kwargs)) if tags else ((f"user:{user_id}",) if user_id else ())
 
+            async def load():
+                result = func(*args, **kwargs)
+                if inspect.isawaitable(result):
+                    result = await result
+                body = adapter.dump_json(adapter.validate_python(result, from_attributes=True))
+                entry = {"headers": {name: response.headers[name] for name in headers if name in response.headers}}
+                if len(body) < MINIMUM_SIZE:
+                    entry["body"] = body.decode()
+                else:
+                    entry["encoded"] = {
+                        encoding: base64.b64encode(data).decode()
+                        for encoding, data in compress_variants(body).items()
+                    }
+                return entry
 
-def invalidate_pattern(pattern: str):
-    """Invalidate cache keys matching pattern"""
-    if REDIS_AVAILABLE:
-        try:
-            keys = redis_client.keys(pattern)
-            if keys:
-                redis_client.delete(*keys)
-        except Exception:
-            pass
-    else:
-        # For in-memory cache, clear all (simple implementation)
-        _memory_cache.clear()
+            cached = await get_or_load(
+                get_cache_key(request, key_prefix, user_id), load, ttl=ttl, stale_ttl=stale_ttl, tags=key_tags
+            )
+            encoding = None
+            if "body" in cached:
+                body = cached["body"]
+            else:
+                encoded = cached["encoded"]
+                encoding = negotiate(request.headers.get("accept-encoding"), encoded)
+                # Gzip is always stored, so it can serve clients that take no encoding we have
+                body = base64.b64decode(encoded[encoding or "gzip"])
+                if encoding is None:
+                    body = decompress(body, "gzip")
+            raw = Response(content=body, media_type="application/json")
+            raw.headers.update(response.headers)
+            raw.headers.update(cached["headers"])
+            if encoding is not None:
+                # The compression middleware passes encoded bodies through untouched
+                raw.headers["Content-Encoding"] = encoding
+                raw.headers.add_vary_header("Accept-Encoding")
+            return raw
+        return wrapper
+    return decorator
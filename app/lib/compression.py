@@ -0,0 +1,197 @@
+"""
+Response compression with zstd / brotli / gzip negotiation
+
+``CompressionMiddleware`` replaces Starlette's GZipMiddleware: it picks the
+best encoding the client accepts and compresses dynamic responses, including
+streamed ones such as admin exports, at cheap levels. Responses that already
+carry a Content-Encoding (pre-compressed cache hits) and event streams pass
+through untouched.
+
+``compress_variants`` produces the stored forms for the response cache at
+higher levels, since that cost is paid once per cache fill rather than per
+request. zstd and brotli are optional; without them only gzip is offered.
+"""
+import gzip
+import zlib
+from typing import Callable, Dict, Iterable, Optional
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this aren't worth a Content-Encoding
+MINIMUM_SIZE = 1000
+
+# Server preference when the client rates several encodings equally
+AVAILABLE_ENCODINGS = tuple(
+    name for name, module in (("zstd", zstandard), ("br", brotli), ("gzip", gzip)) if module is not None
+)
+
+# Streams that clients read as they arrive; compressing would hold them back
+EXCLUDED_CONTENT_TYPES = ("text/event-stream",)
+
+# Per-request levels: fast, most of the ratio
+STREAM_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+# Cache-fill levels: slower, paid once per cached body
+STORED_LEVELS = {"zstd": 10, "br": 5, "gzip": 9}
+
+
+def negotiate(accept_encoding: Optional[str], offered: Iterable[str] = AVAILABLE_ENCODINGS) -> Optional[str]:
+    """Best of `offered` for an Accept-Encoding header, or None for identity."""
+    if not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for name in offered:
+        q = weights.get(name, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def compress(body: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    level = STORED_LEVELS[encoding] if level is None else level
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(body)
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=level)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+def decompress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        # Streamed frames don't record their size, which one-shot decompress() needs
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    if encoding == "br":
+        return brotli.decompress(body)
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+def compress_variants(body: bytes) -> Dict[str, bytes]:
+    """Every available encoding of `body`, at the cache-fill levels."""
+    return {encoding: compress(body, encoding) for encoding in AVAILABLE_ENCODINGS}
+
+
+def stream_compressor(encoding: str, level: int) -> Callable[[bytes, bool], bytes]:
+    """Incremental compressor: call with each chunk and whether more follow."""
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+        def apply(body: bytes, more_body: bool) -> bytes:
+            # Flush each streamed chunk so clients can decode as it arrives
+            flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK if more_body else zstandard.COMPRESSOBJ_FLUSH_FINISH
+            return compressor.compress(body) + compressor.flush(flush)
+    elif encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+
+        def apply(body: bytes, more_body: bool) -> bytes:
+            data = compressor.process(body)
+            return data + (compressor.flush() if more_body else compressor.finish())
+    elif encoding == "gzip":
+        # wbits=31 writes the gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+        def apply(body: bytes, more_body: bool) -> bytes:
+            return compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+    else:
+        raise ValueError(f"Unsupported encoding: {encoding}")
+    return apply
+
+
+class CompressionResponder:
+    """
+    Sends one response, compressed with `encoding` once its first chunk
+    reaches `minimum_size`; with no `encoding` the body goes out as is.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int, encoding: Optional[str]):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.encoding = encoding
+        self.compress = stream_compressor(encoding, STREAM_LEVELS[encoding]) if encoding else None
+        self.send: Optional[Send] = None
+        self.initial_message: Message = {}
+        self.started = False
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message):
+        if message["type"] == "http.response.start":
+            # Held back until the first chunk decides the headers
+            self.initial_message = message
+            headers = Headers(raw=message["headers"])
+            self.passthrough = "content-encoding" in headers or headers.get("content-type", "").startswith(
+                EXCLUDED_CONTENT_TYPES
+            )
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._start()
+            await self.send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.started:
+            if self.compress is not None:
+                message["body"] = self.compress(body, more_body)
+            await self.send(message)
+            return
+        if len(body) < self.minimum_size and not more_body:
+            await self._start()
+            await self.send(message)
+            return
+        headers = MutableHeaders(raw=self.initial_message["headers"])
+        headers.add_vary_header("Accept-Encoding")
+        if self.compress is not None:
+            message["body"] = self.compress(body, more_body)
+            headers["Content-Encoding"] = self.encoding
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(message["body"]))
+        await self._start()
+        await self.send(message)
+
+    async def _start(self):
+        if not self.started:
+            self.started = True
+            await self.send(self.initial_message)
+
+
+class CompressionMiddleware:
+    """Negotiated zstd / br / gzip compression for responses of at least `minimum_size` bytes."""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"))
+        await CompressionResponder(self.app, self.minimum_size, encoding)(scope, receive, send)
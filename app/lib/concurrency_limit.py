@@ -0,0 +1,172 @@
+"""
+Adaptive concurrency limiting for calls to downstream services
+
+Each limiter keeps a gradient-style limit on in-flight calls. A short-window
+average of call latency is compared with a long-window baseline: while recent
+calls run about as fast as usual the limit grows by roughly its square root
+per round trip, and once they run well over the baseline (queueing) it
+shrinks in proportion. Single slow calls barely move the short average, so
+ordinary variance (e.g. generation time following answer length) is not read
+as overload, and the baseline stands still while queueing so the delay can't
+become the new normal. Timeouts and overload errors cut the limit multiplicatively;
+cancelled calls aren't measured at all. Request-path callers over the limit
+are rejected at once with a 503 and ``Retry-After``; background jobs can wait
+for a slot instead.
+"""
+import asyncio
+from math import ceil, sqrt
+from time import monotonic
+from collections import deque
+from typing import Callable, Optional
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, status
+
+
+class ConcurrencyLimitExceeded(HTTPException):
+    def __init__(self, detail: str, retry_after: int):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=detail,
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.retry_after = retry_after
+
+
+class AdaptiveConcurrencyLimiter:
+    """Gradient limit on concurrent calls, driven by smoothed latency and errors."""
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: int = 16,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        backoff: float = 0.9,
+        tolerance: float = 1.5,
+        short_window: int = 20,
+        long_window: int = 500,
+        smoothing: float = 0.2,
+        is_overload: Callable[[BaseException], bool] = lambda e: True,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.short_window = short_window
+        self.smoothing = smoothing
+        self.is_overload = is_overload
+        self._short_alpha = 2 / (short_window + 1)
+        self._long_alpha = 2 / (long_window + 1)
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._samples = 0
+        self._latency: Optional[float] = None
+        self._baseline: Optional[float] = None
+        self._last_decrease = 0.0
+        self._waiters: deque = deque()
+        self.rejected = 0
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def retry_after(self) -> int:
+        """Seconds a rejected caller should back off: about one call's latency."""
+        return min(30, max(1, ceil(self._latency or 1)))
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "latency_ms": round(self._latency * 1000, 1) if self._latency is not None else None,
+            "baseline_ms": round(self._baseline * 1000, 1) if self._baseline is not None else None,
+            "rejected": self.rejected,
+        }
+
+    @asynccontextmanager
+    async def slot(self, wait: bool = False):
+        """Hold one unit of concurrency for the duration of the block."""
+        if self._in_flight >= self.limit:
+            if not wait:
+                self.rejected += 1
+                raise ConcurrencyLimitExceeded(
+                    f"{self.name} is at capacity. Please retry shortly.", self.retry_after()
+                )
+            while self._in_flight >= self.limit:
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    # Pass on a wake-up this caller can no longer use
+                    if not waiter.cancelled():
+                        self._wake_waiters()
+                    raise
+        self._in_flight += 1
+        started = monotonic()
+        dropped = False
+        measured = True
+        try:
+            yield
+        except asyncio.CancelledError:
+            # Client disconnects and hedge losers say nothing about the
+            # server's latency; give the slot back without measuring
+            measured = False
+            raise
+        except BaseException as e:
+            dropped = self.is_overload(e)
+            raise
+        finally:
+            self._in_flight -= 1
+            if measured:
+                self._record(monotonic() - started, dropped)
+            self._wake_waiters()
+
+    def _record(self, latency: float, dropped: bool):
+        if dropped:
+            # One cut per observed round trip so a burst of timeouts from the
+            # same window doesn't collapse the limit to the floor
+            now = monotonic()
+            if now - self._last_decrease >= (self._latency or 0):
+                self._limit = max(self.min_limit, self._limit * self.backoff)
+                self._last_decrease = now
+            return
+        self._samples += 1
+        if self._latency is None:
+            self._latency = self._baseline = latency
+            return
+        # Plain running means until each window has filled
+        self._latency += max(self._short_alpha, 1 / self._samples) * (latency - self._latency)
+        queueing = self._latency > self.tolerance * self._baseline
+        app_limited = self._in_flight + 1 < self.limit / 2
+        if not queueing or app_limited or self.limit <= self.min_limit:
+            # Queueing delay mustn't become the new normal. Slow calls only
+            # move the baseline when our own concurrency can't explain them
+            self._baseline += max(self._long_alpha, 1 / self._samples) * (latency - self._baseline)
+        if self._samples < self.short_window:
+            return
+        if self._baseline > 2 * self._latency:
+            # Queueing has cleared; let the long-term latency catch up faster
+            self._baseline *= 0.95
+        if app_limited:
+            # Only adjust while the current limit is actually being used
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * self._baseline / self._latency))
+        target = self._limit * gradient + sqrt(self._limit)
+        # A full limit's worth of samples arrives per round trip: move a
+        # `smoothing` share of the way to the target per round trip, not per call
+        self._limit += self.smoothing * (target - self._limit) / self._limit
+        self._limit = max(self.min_limit, min(self.max_limit, self._limit))
+
+    def _wake_waiters(self):
+        free = self.limit - self._in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
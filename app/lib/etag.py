@@ -0,0 +1,31 @@
+"""
+Weak ETags for per-user GET routes
+
+The tag is a digest of the user's cache-tag version (see
+``cache.tag_version``) and the request URL, so it changes whenever a write
+path calls ``invalidate_tag(f"user:{id}")`` and checking it needs neither the
+database nor the cached body.
+"""
+import hashlib
+from typing import Optional
+from fastapi import Request
+from app.lib.cache import tag_version
+
+
+async def user_etag(request: Request, user_id) -> Optional[str]:
+    """Weak ETag for this URL and user's data; None when the version is unavailable."""
+    version = await tag_version(f"user:{user_id}")
+    if version is None:
+        return None
+    key = f"{version}:{user_id}:{request.url.path}:{request.url.query}"
+    return f'W/"{hashlib.md5(key.encode()).hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of If-None-Match against `etag` (RFC 9110, 13.1.2)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
@@ -0,0 +1,139 @@
+"""
+Hedged requests and retry budgets for idempotent downstream calls
+
+A hedger starts a second attempt when the first hasn't answered within the
+recent p95 latency and returns whichever finishes first. A failed call gets
+one retry. Both extra attempts are paid for from a shared ``RetryBudget`` that
+only refills as a fraction of normal traffic, so an outage can't multiply the
+load on a struggling server.
+"""
+import asyncio
+from time import monotonic
+from collections import Counter, deque
+from typing import Awaitable, Callable, Optional
+
+
+class RetryBudget:
+    """Allows extra attempts up to ``ratio`` of calls, plus a small reserve for bursts."""
+
+    def __init__(self, ratio: float = 0.1, reserve: int = 10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._balance = float(reserve)
+
+    def deposit(self):
+        self._balance = min(self.reserve, self._balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self._balance < 1:
+            return False
+        self._balance -= 1
+        return True
+
+
+class LatencyTracker:
+    """Rolling window of recent attempt latencies."""
+
+    def __init__(self, window: int = 500, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Hedger:
+    """Runs an idempotent call with at most one hedge and one retry."""
+
+    def __init__(
+        self,
+        budget: RetryBudget,
+        percentile: float = 95.0,
+        min_delay: float = 0.05,
+        hedge: bool = True,
+        is_retryable: Callable[[BaseException], bool] = lambda e: True,
+    ):
+        self.budget = budget
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.hedge = hedge
+        self.is_retryable = is_retryable
+        self.latency = LatencyTracker()
+        self.counts = Counter()
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging; None until there are enough samples."""
+        if not self.hedge:
+            return None
+        p = self.latency.percentile(self.percentile)
+        return None if p is None else max(self.min_delay, p)
+
+    def stats(self) -> dict:
+        delay = self.hedge_delay()
+        return {
+            "hedge_delay_ms": round(delay * 1000, 1) if delay is not None else None,
+            **{key: self.counts[key] for key in ("calls", "hedged", "hedge_won", "retried", "budget_exhausted")},
+        }
+
+    async def _timed(self, attempt: Callable[[], Awaitable]):
+        started = monotonic()
+        try:
+            result = await attempt()
+        except asyncio.CancelledError:
+            # A cancelled loser took at least this long; keep it in the window
+            # so hedging doesn't drag its own p95 down
+            self.latency.observe(monotonic() - started)
+            raise
+        self.latency.observe(monotonic() - started)
+        return result
+
+    async def __call__(self, attempt: Callable[[], Awaitable]):
+        self.counts["calls"] += 1
+        self.budget.deposit()
+        delay = self.hedge_delay()
+        primary = asyncio.create_task(self._timed(attempt))
+        running = {primary}
+        retried = False
+        error = None
+        try:
+            while running:
+                done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    delay = None
+                    if self.budget.withdraw():
+                        self.counts["hedged"] += 1
+                        running.add(asyncio.create_task(self._timed(attempt)))
+                    else:
+                        self.counts["budget_exhausted"] += 1
+                    continue
+                for task in done:
+                    running.discard(task)
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.counts["hedge_won"] += 1
+                        return task.result()
+                    error = task.exception()
+                if running or retried or not self.is_retryable(error):
+                    continue
+                retried = True
+                if self.budget.withdraw():
+                    self.counts["retried"] += 1
+                    delay = None
+                    running.add(asyncio.create_task(self._timed(attempt)))
+                else:
+                    self.counts["budget_exhausted"] += 1
+            raise error
+        finally:
+            for task in running:
+                task.cancel()
+            for task in running:
+                try:
+                    await task
+                except BaseException:
+                    pass
@@ -1,147 +1,229 @@
 """
-Rate limiting middleware using sliding window algorithm
+Rate limiting middleware using sliding window or GCRA algorithms
+
+Each request costs one atomic Lua call that both records the hit and returns
+the remaining budget. Without Redis a bounded in-process store is used.
 """
-from collections import defaultdict
+import uuid
+from math import ceil
 from time import time
-from fastapi import Request, HTTPException, status
-from starlette.middleware.base import BaseHTTPMiddleware
-from typing import Dict, Tuple
-import redis
+from collections import OrderedDict, deque
+from fastapi import status
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import Dict, Iterable, NamedTuple, Tuple
 from app.config import settings
+from app.lib.redis_pool import get_redis
+from app.lib.auth_client import decode_token
 
 get_settings = settings()
 
-# Rate limit storage (in-memory fallback if Redis unavailable)
-_rate_limit_store: Dict[str, list] = defaultdict(list)
-
-
-def _make_redis_client():
-    """Create Redis client from REDIS_URL or REDIS_HOST/PORT/DB."""
-    if get_settings.REDIS_URL:
-        return redis.from_url(
-            get_settings.REDIS_URL,
-            decode_responses=True,
-            socket_connect_timeout=5,
-            socket_timeout=5,
-        )
-    return redis.Redis(
-        host=get_settings.REDIS_HOST,
-        port=get_settings.REDIS_PORT,
-        db=1,  # use db=1 for rate limit when using host/port to avoid clashing with cache
-        decode_responses=True,
-        socket_connect_timeout=5,
-        socket_timeout=5,
-    )
-
-
-# Initialize Redis for distributed rate limiting
-try:
-    redis_client = _make_redis_client()
-    redis_client.ping()
-    REDIS_AVAILABLE = True
-except Exception as e:
-    REDIS_AVAILABLE = False
-    print(f"Redis not available for rate limiting, using in-memory store: {e}")
-
-
-class RateLimitMiddleware(BaseHTTPMiddleware):
-    """Rate limiting middleware"""
-    
-    def __init__(self, app, calls: int = 100, period: int = 60):
-        super().__init__(app)
-        self.calls = calls
-        self.period = period
-    
-    async def dispatch(self, request: Request, call_next):
-        # Skip rate limiting for health checks
-        if request.url.path in ["/health", "/", "/ml-server/health"]:
-            return await call_next(request)
-        
-        # Get client identifier
-        client_id = self._get_client_id(request)
-        
-        # Check rate limit
-        if not self._check_rate_limit(client_id, request.url.path):
-            raise HTTPException(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail="Rate limit exceeded. Please try again later."
-            )
-        
-        response = await call_next(request)
-        
-        # Add rate limit headers
-        remaining = self._get_remaining(client_id, request.url.path)
-        response.headers["X-RateLimit-Limit"] = str(self.calls)
-        response.headers["X-RateLimit-Remaining"] = str(remaining)
-        response.headers["X-RateLimit-Reset"] = str(int(time()) + self.period)
-        
-        return response
-    
-    def _get_client_id(self, request: Request) -> str:
-        """Get unique client identifier"""
-        # Try to get user ID from token if available
-        auth_header = request.headers.get("Authorization", "")
-        if auth_header.startswith("Bearer "):
-            token = auth_header.split(" ")[1]
-            # In production, decode token to get user ID
-            # For now, use IP + token hash
-            return f"{request.client.host}:{hash(token) % 10000}"
-        return request.client.host
-    
-    def _check_rate_limit(self, client_id: str, path: str) -> bool:
-        """Check if request is within rate limit"""
-        key = f"{client_id}:{path}"
+SLIDING_WINDOW = "sliding_window"
+GCRA = "gcra"
+
+# KEYS[1] = window zset; ARGV = now_ms, period_ms, calls, member
+_SLIDING_WINDOW_LUA = """
+local now = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local calls = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - period)
+local count = redis.call('ZCARD', KEYS[1])
+local allowed = 0
+if count < calls then
+    redis.call('ZADD', KEYS[1], now, ARGV[4])
+    count = count + 1
+    allowed = 1
+end
+redis.call('PEXPIRE', KEYS[1], period)
+local reset = period
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if oldest[2] then
+    reset = tonumber(oldest[2]) + period - now
+end
+local retry = 0
+if allowed == 0 then
+    retry = reset
+end
+return {allowed, calls - count, reset, retry}
+"""
+
+# KEYS[1] = theoretical arrival time (ms); ARGV = now_ms, period_ms, calls
+_GCRA_LUA = """
+local now = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local interval = period / tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+if new_tat - now > period then
+    return {0, 0, math.ceil(tat - now), math.ceil(new_tat - now - period)}
+end
+redis.call('SET', KEYS[1], new_tat, 'PX', math.ceil(new_tat - now))
+return {1, math.floor((period - (new_tat - now)) / interval), math.ceil(new_tat - now), 0}
+"""
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    remaining: int
+    reset_after: float  # seconds until the budget starts refilling
+    retry_after: float = 0.0  # seconds until the next hit would be allowed
+
+
+class _LocalStore:
+    """Bounded in-memory fallback; least recently used keys are evicted first."""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._entries: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+
+    def get(self, key: str, now: float):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, state = entry
+        if expires_at <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return state
+
+    def put(self, key: str, state, expires_at: float):
+        self._entries[key] = (expires_at, state)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+
+class RateLimiter:
+    """Counts hits per key against a `calls` per `period` seconds budget."""
+
+    def __init__(self, algorithm: str = GCRA, max_local_keys: int = 10000):
+        if algorithm not in (SLIDING_WINDOW, GCRA):
+            raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self._local = _LocalStore(max_local_keys)
+
+    async def hit(self, key: str, calls: int, period: int) -> RateLimitResult:
         now = time()
-        
-        if REDIS_AVAILABLE:
+        redis_client = get_redis()
+        if redis_client is not None:
             try:
-                # Use Redis sorted set for sliding window
-                pipe = redis_client.pipeline()
-                pipe.zremrangebyscore(key, 0, now - self.period)
-                pipe.zcard(key)
-                pipe.zadd(key, {str(now): now})
-                pipe.expire(key, self.period)
-                results = pipe.execute()
-                count = results[1]
-                return count < self.calls
+                return await self._hit_redis(redis_client, key, calls, period, now)
             except Exception:
                 # Fallback to in-memory
                 pass
-        
-        # In-memory rate limiting
-        if key not in _rate_limit_store:
-            _rate_limit_store[key] = []
-        
-        # Remove old entries
-        _rate_limit_store[key] = [
-            t for t in _rate_limit_store[key] 
-            if now - t < self.period
-        ]
-        
-        if len(_rate_limit_store[key]) >= self.calls:
-            return False
-        
-        _rate_limit_store[key].append(now)
-        return True
-    
-    def _get_remaining(self, client_id: str, path: str) -> int:
-        """Get remaining requests"""
-        key = f"{client_id}:{path}"
-        now = time()
-        
-        if REDIS_AVAILABLE:
-            try:
-                count = redis_client.zcount(key, now - self.period, now)
-                return max(0, self.calls - count)
-            except Exception:
-                pass
-        
-        if key not in _rate_limit_store:
-            return self.calls
-        
-        _rate_limit_store[key] = [
-            t for t in _rate_limit_store[key] 
-            if now - t < self.period
-        ]
-        
-        return max(0, self.calls - len(_rate_limit_store[key]))
+        if self.algorithm == GCRA:
+            return self._hit_local_gcra(key, calls, period, now)
+        return self._hit_local_window(key, calls, period, now)
+
+    async def _hit_redis(self, redis_client, key, calls, period, now) -> RateLimitResult:
+        now_ms, period_ms = int(now * 1000), period * 1000
+        if self.algorithm == GCRA:
+            script = redis_client.register_script(_GCRA_LUA)
+            args = [now_ms, period_ms, calls]
+        else:
+            script = redis_client.register_script(_SLIDING_WINDOW_LUA)
+            # Unique member so simultaneous requests don't collapse into one
+            args = [now_ms, period_ms, calls, f"{now_ms}-{uuid.uuid4().hex[:8]}"]
+        allowed, remaining, reset_ms, retry_ms = await script(keys=[f"ratelimit:{key}"], args=args)
+        return RateLimitResult(bool(allowed), max(0, int(remaining)), int(reset_ms) / 1000, int(retry_ms) / 1000)
+
+    def _hit_local_gcra(self, key, calls, period, now) -> RateLimitResult:
+        interval = period / calls
+        tat = max(self._local.get(key, now) or now, now)
+        new_tat = tat + interval
+        if new_tat - now > period:
+            return RateLimitResult(False, 0, tat - now, new_tat - now - period)
+        self._local.put(key, new_tat, new_tat)
+        return RateLimitResult(True, int((period - (new_tat - now)) / interval), new_tat - now)
+
+    def _hit_local_window(self, key, calls, period, now) -> RateLimitResult:
+        hits = self._local.get(key, now)
+        if hits is None:
+            hits = deque(maxlen=calls)
+        while hits and hits[0] <= now - period:
+            hits.popleft()
+        allowed = len(hits) < calls
+        if allowed:
+            hits.append(now)
+        reset_after = hits[0] + period - now if hits else period
+        self._local.put(key, hits, now + reset_after)
+        return RateLimitResult(allowed, calls - len(hits), reset_after, 0.0 if allowed else reset_after)
+
+
+class RateLimitPolicy(NamedTuple):
+    calls: int
+    period: int
+
+
+class RateLimitMiddleware:
+    """
+    Pure ASGI rate limiting middleware
+
+    Each path gets its own budget from ``policies`` (falling back to
+    ``default``), counted per verified JWT subject, or per client IP for
+    anonymous requests. Verified claims are left in ``request.state.token_payload``
+    so the auth dependency doesn't decode the token again.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        policies: Dict[str, RateLimitPolicy] = None,
+        default: RateLimitPolicy = RateLimitPolicy(calls=100, period=60),
+        exempt: Iterable[str] = ("/health", "/", "/ml-server/health"),
+        algorithm: str = None,
+    ):
+        self.app = app
+        self.policies = dict(policies or {})
+        self.default = default
+        self.exempt = frozenset(exempt)
+        self.limiter = RateLimiter(algorithm or get_settings.RATE_LIMIT_ALGORITHM)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path in self.exempt:
+            return await self.app(scope, receive, send)
+
+        policy = self.policies.get(path, self.default)
+        client_id = self._get_client_id(scope)
+
+        # Check rate limit and read the remaining budget in one call
+        result = await self.limiter.hit(f"{client_id}:{path}", policy.calls, policy.period)
+        headers = {
+            "X-RateLimit-Limit": str(policy.calls),
+            "X-RateLimit-Remaining": str(result.remaining),
+            "X-RateLimit-Reset": str(int(time() + result.reset_after)),
+        }
+        if not result.allowed:
+            headers["Retry-After"] = str(max(1, ceil(result.retry_after)))
+            response = JSONResponse(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                content={"detail": "Rate limit exceeded. Please try again later."},
+                headers=headers,
+            )
+            return await response(scope, receive, send)
+
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                response_headers = MutableHeaders(scope=message)
+                for name, value in headers.items():
+                    response_headers.append(name, value)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+    def _get_client_id(self, scope: Scope) -> str:
+        """Verified JWT subject when present, client IP otherwise"""
+        auth_header = Headers(scope=scope).get("authorization", "")
+        if auth_header.startswith("Bearer "):
+            payload = decode_token(auth_header[len("Bearer "):])
+            if payload and payload.get("sub"):
+                scope.setdefault("state", {})["token_payload"] = payload
+                return f"user:{payload['sub']}"
+        client = scope.get("client")
+        return f"ip:{client[0] if client else 'unknown'}"
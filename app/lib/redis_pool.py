@@ -0,0 +1,63 @@
+"""
+Shared asyncio Redis client for the cache and the rate limiter
+
+Both modules issue commands from request handlers and middleware, so the
+client must never block the event loop. One connection pool is opened at
+startup; callers use ``get_redis()`` and fall back to their in-process
+stores when it returns None.
+"""
+import redis.asyncio as redis
+from typing import Optional
+from app.config import settings
+
+get_settings = settings()
+
+_client: Optional[redis.Redis] = None
+
+
+def _make_redis_client() -> redis.Redis:
+    """Create Redis client from REDIS_URL or REDIS_HOST/PORT/DB."""
+    options = dict(
+        decode_responses=True,
+        socket_connect_timeout=get_settings.REDIS_CONNECT_TIMEOUT,
+        socket_timeout=get_settings.REDIS_SOCKET_TIMEOUT,
+        max_connections=get_settings.REDIS_MAX_CONNECTIONS,
+        health_check_interval=30,
+    )
+    if get_settings.REDIS_URL:
+        # Use full URL (supports redis:// and rediss:// for TLS)
+        return redis.from_url(get_settings.REDIS_URL, **options)
+    return redis.Redis(
+        host=get_settings.REDIS_HOST,
+        port=get_settings.REDIS_PORT,
+        db=get_settings.REDIS_DB,
+        **options,
+    )
+
+
+async def init_redis() -> bool:
+    """Open the shared pool; returns False (in-memory mode) if Redis is unreachable."""
+    global _client
+    client = None
+    try:
+        client = _make_redis_client()
+        await client.ping()
+    except Exception as e:
+        if client is not None:
+            await client.aclose()
+        print(f"Redis not available, using in-memory stores: {e}")
+        return False
+    _client = client
+    return True
+
+
+async def close_redis():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """Return the shared client, or None when running without Redis."""
+    return _client
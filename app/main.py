@@ -1,3 +1,4 @@
+import json
 import uuid
 import httpx
 import logging
@@ -9,32 +10,41 @@ import app.services.extract as extract
 # Suppress boto3 Python 3.9 deprecation warning
 warnings.filterwarnings("ignore", category=DeprecationWarning, module="boto3")
 
-from typing import List
+from typing import List, Optional, Tuple
+from time import perf_counter
+from datetime import datetime, timezone
 from sqlalchemy.orm import Session, joinedload
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
-from sqlalchemy.orm.attributes import flag_modified
+from fastapi.responses import StreamingResponse
 from fastapi_mail import FastMail, MessageSchema, MessageType
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi import Form, FastAPI, UploadFile, File, HTTPException, Depends, Security, BackgroundTasks, Request
+from fastapi import Form, FastAPI, UploadFile, File, HTTPException, Depends, Security, BackgroundTasks, Request, Response, Query
 
 import app.services.extract as extract
 
 from app.config import settings
 from app.db.models import User, Source, UserRole
-from app.lib.aws_client import s3_client
+from app.lib.aws_client import delete_s3_objects
 from contextlib import asynccontextmanager
 from app.db.connect import init_db, get_db
+from app.db.pagination import paginate, decode_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 from app.lib.aws_client import upload_to_s3
 from app.lib.mail_client import conf, create_html_body, create_resolve_html_body
-from app.lib.cache import get_cache_key, get, set, delete
-from app.lib.rate_limit import RateLimitMiddleware
+from app.lib.cache import get_cache_key, get, set, delete, get_or_load, cache_response, invalidate_tag, start_invalidation_listener, stop_invalidation_listener
+from app.lib.redis_pool import init_redis, close_redis
+from app.lib.compression import CompressionMiddleware
+from app.lib.etag import user_etag, etag_matches
+from app.lib.rate_limit import RateLimitMiddleware, RateLimitPolicy
 from app.lib.logging_config import setup_logging
-from app.db.cruds import create_file_record, get_or_create_source
-from app.lib.auth_client import hash_password, verify_password, create_access_token, decode_token
+from app.db.cruds import create_file_record, get_or_create_source, deduct_credits, find_conversation_id, search_chunk_contents, save_chat_exchange, refresh_source_embedding, search_analyses, delete_file_records
+from app.lib.auth_client import hash_password, verify_password, create_access_token, decode_token, get_cached_principal, cache_principal
 from app.db.models import ResumeAnalysis, AnalysisStatus, SourceChunk, ChatMessage, Conversation,Feedback
-from app.services.ml_process import ml_analysis_s3, ml_analysis_drive, ml_health_check, ml_analysis_video, ml_analysis_document
-from app.db.schemas import FolderDataSchema, AnalysisResponseSchema,StatusUpdateSchema, VideoIngestRequestSchema, SyncRequestSchema, ConnectDataSchema, SourceSchema, ChatRequestSchema, FeedbackSchema, FeedbackResolveSchema
+from app.services.admin_export import ENTITIES, export_ndjson, export_document
+from app.services.admin_stats import read_stats, mark_stale, start_stats_refresher, stop_stats_refresher
+from app.services.history_retention import start_history_trimmer, stop_history_trimmer
+from app.services.ml_process import ml_analysis_s3, ml_analysis_drive, ml_health_check, ml_analysis_video, ml_analysis_document, ml_get_vector, ml_generate_answer, ml_cancel_generation, close_ml_clients, generation_counts, ml_limiters, ml_hedgers
+from app.db.schemas import FolderDataSchema, AnalysisResponseSchema,StatusUpdateSchema, VideoIngestRequestSchema, SyncRequestSchema, ConnectDataSchema, SourceSchema, ChatRequestSchema, FeedbackSchema, FeedbackResolveSchema, PrincipalSchema, ConversationSchema, ChatMessageSchema
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -48,9 +58,18 @@ async def lifespan(app: FastAPI):
     
     init_db()
     logger.info("Database initialized")
+    await init_redis()
+    await start_invalidation_listener()
+    await start_stats_refresher()
+    await start_history_trimmer()
     
     yield
     
+    await stop_history_trimmer()
+    await stop_stats_refresher()
+    await close_ml_clients()
+    await stop_invalidation_listener()
+    await close_redis()
     logger.info("Shutting down Alluvium Backend...")
 
 security = HTTPBearer()
@@ -59,10 +78,23 @@ app = FastAPI(lifespan=lifespan)
 logger = logging.getLogger(__name__)
 
 # Add compression middleware (should be first)
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(CompressionMiddleware)
 
-# Add rate limiting middleware
-app.add_middleware(RateLimitMiddleware, calls=100, period=60)
+# Add rate limiting middleware: ML-backed and ingestion routes get tight budgets
+app.add_middleware(
+    RateLimitMiddleware,
+    default=RateLimitPolicy(calls=300, period=60),
+    policies={
+        "/chat": RateLimitPolicy(calls=20, period=60),
+        "/ingest-video": RateLimitPolicy(calls=10, period=60),
+        "/ingest-document": RateLimitPolicy(calls=10, period=60),
+        "/upload": RateLimitPolicy(calls=10, period=60),
+        "/get-folder": RateLimitPolicy(calls=10, period=60),
+        "/get-description": RateLimitPolicy(calls=30, period=60),
+        "/file-to-text": RateLimitPolicy(calls=30, period=60),
+        "/connect": RateLimitPolicy(calls=20, period=60),
+    },
+)
 
 # Add CORS middleware
 app.add_middleware(
@@ -74,6 +106,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 # --- Startup Route ---
@@ -85,42 +118,56 @@ app.add_middleware(
 
 # --- Auth Dependency ---
 async def get_current_user(
+    request: Request,
     credentials: HTTPAuthorizationCredentials = Security(security), 
     db: Session = Depends(get_db)
-):
-    token = credentials.credentials
-    payload = decode_token(token)
+) -> PrincipalSchema:
+    # Reuse the claims the rate limiter already verified for this request
+    payload = getattr(request.state, "token_payload", None) or decode_token(credentials.credentials)
     if not payload:
         raise HTTPException(status_code=401, detail="Invalid or expired session token")
     
-    # Cache user lookup for 5 minutes
-    cache_key = f"user:{payload['sub']}"
-    cached_user = get(cache_key)
-    if cached_user:
-        return cached_user
+    # Warm cache: serve the principal snapshot without touching the DB
+    principal = await get_cached_principal(payload["sub"])
+    if principal:
+        return principal
     
     user = db.query(User).filter(User.email == payload["sub"]).first()
     if not user:
         raise HTTPException(status_code=404, detail="User account not found")
     
-    # Cache user for 5 minutes
-    set(cache_key, user, ttl=300)
-    return user
+    return await cache_principal(user)
+
+# --- Helper Logic: Request Parameters ---
+def page_params(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+) -> Tuple[int, Optional[str]]:
+    """limit/cursor query parameters shared by list routes; the next cursor goes in X-Next-Cursor."""
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    return limit, cursor
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]):
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
 
-# --- Helper Logic: Persistence ---
-def save_to_history(background_tasks: BackgroundTasks,db: Session, user: User, new_results: List[dict]):
-    if not new_results:
+async def conditional_get(
+    request: Request,
+    response: Response,
+    current_user: PrincipalSchema = Depends(get_current_user),
+):
+    """Answer 304 when the client's ETag still matches the user's data version, before any DB or cache read."""
+    etag = await user_etag(request, current_user.id)
+    if etag is None:
         return
-    current_history = list(user.analysis_history or [])
-    updated_history = (new_results + current_history)[:100]
-    user.analysis_history = updated_history
-    new_filenames = [r["filename"] for r in new_results]
-    user.processed_filenames = (list(user.processed_filenames or []) + new_filenames)[-100:]
-    flag_modified(user, "analysis_history")
-    flag_modified(user, "processed_filenames")
-    
-    db.commit()
-    db.refresh(user)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        raise HTTPException(status_code=304, headers=headers)
+    response.headers.update(headers)
 
 # --- Root Routes ---
 @app.get("/")
@@ -133,6 +180,18 @@ async def health_check():
 async def health_check():
     is_awake = await ml_health_check()
     return {"service":"ML Server", "status": "healthy" if is_awake else "unhealthy", "active":is_awake}
+@app.get("/ml-server/stats")
+async def ml_stats(current_user: PrincipalSchema = Depends(get_current_user)):
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(
+            status_code=403,
+            detail="Access denied. Administrator privileges required",
+        )
+    return {
+        "generations": {key: generation_counts[key] for key in ("completed", "cancelled", "failed")},
+        "limits": {name: limiter.stats() for name, limiter in ml_limiters.items()},
+        "hedging": {name: hedger.stats() for name, hedger in ml_hedgers.items()},
+    }
 
 # --- Authentication Routes ---
 @app.post("/connect")
@@ -154,12 +213,12 @@ async def connect(background_tasks: BackgroundTasks,data: ConnectDataSchema, db:
     new_user = User(
         email=data.email, 
         hashed_password=hash_password(data.password),
-        linked_folder_ids=[],
-        processed_filenames=[]
+        linked_folder_ids=[]
     )
     db.add(new_user)
     db.commit()
     db.refresh(new_user)
+    mark_stale()
     
     token = create_access_token(data={"sub": new_user.email})
     return {
@@ -169,19 +228,19 @@ async def connect(background_tasks: BackgroundTasks,data: ConnectDataSchema, db:
         "id": str(new_user.id),
         "role": new_user.role.value,
     }
-@app.get("/auth/me")
+@app.get("/auth/me", dependencies=[Depends(conditional_get)])
 async def get_me(
     request: Request,
     background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: PrincipalSchema = Depends(get_current_user)
 ):
     # Cache response for 1 minute
     cache_key = get_cache_key(request, "auth", user_id=str(current_user.id))
-    cached = get(cache_key)
+    cached = await get(cache_key)
     # Invalidate old cache entries that don't have role field
     if cached and "role" not in cached:
-        delete(cache_key)
+        await delete(cache_key)
         cached = None
     if cached:
         return cached
@@ -201,7 +260,7 @@ async def get_me(
         "role": current_user.role.value,
     }
     
-    set(cache_key, result, ttl=60)
+    await set(cache_key, result, ttl=60, tags=[f"user:{current_user.id}"])
     return result
 
 # --- Updation Routes ---
@@ -212,6 +271,8 @@ async def update_source_status(data: StatusUpdateSchema, db: Session = Depends(g
     if src:
         src.status = AnalysisStatus(data.status)
         db.commit()
+        mark_stale()
+        await invalidate_tag(f"user:{src.user_id}")
         return {"message": "updated"}
     raise HTTPException(status_code=404, detail="Source not found")
 
@@ -226,12 +287,16 @@ async def update_source_chunks(data: SyncRequestSchema, db: Session = Depends(ge
         if not existing_source:
             raise HTTPException(status_code=404, detail="Source record not found")
 
-        db.query(SourceChunk).filter(SourceChunk.source_id == source_uuid).delete()
+        db.query(SourceChunk).filter(
+            SourceChunk.user_id == existing_source.user_id,
+            SourceChunk.source_id == source_uuid
+        ).delete()
 
         new_chunks = []
         for item in data.chunks:
             chunk_obj = SourceChunk(
                 source_id=source_uuid,
+                user_id=existing_source.user_id,
                 content=item.content,
                 embedding=item.embedding,
                 status=AnalysisStatus.COMPLETED 
@@ -241,8 +306,11 @@ async def update_source_chunks(data: SyncRequestSchema, db: Session = Depends(ge
         db.add_all(new_chunks)
 
         existing_source.status = AnalysisStatus.COMPLETED
+        refresh_source_embedding(db, source_uuid, existing_source.user_id)
         
         db.commit()
+        mark_stale()
+        await invalidate_tag(f"user:{existing_source.user_id}")
         return {
             "status": "success",
             "count": len(new_chunks),
@@ -254,38 +322,34 @@ async def update_source_chunks(data: SyncRequestSchema, db: Session = Depends(ge
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail="Database Sync Failed")
-@app.get("/get-sources", response_model=List[SourceSchema])
+@app.get("/get-sources", response_model=List[SourceSchema], dependencies=[Depends(conditional_get)])
+# Each page is cached for 2 minutes; one loader per user, others get stale or wait
+@cache_response(List[SourceSchema], ttl=120, key_prefix="sources")
 async def get_user_sources(
     request: Request,
+    response: Response,
+    page: Tuple[int, Optional[str]] = Depends(page_params),
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: PrincipalSchema = Depends(get_current_user),
 ):
+    limit, cursor = page
     try:
-        # Cache sources for 2 minutes
-        cache_key = f"sources:{current_user.id}"
-        cached = get(cache_key)
-        if cached:
-            return cached
-        
         # Optimize query - no need to load chunks here
-        sources = (
-            db.query(Source)
-            .filter(Source.user_id == current_user.id)
-            .order_by(Source.created_at.desc())
-            .all()
+        sources, next_cursor = paginate(
+            db.query(Source).filter(Source.user_id == current_user.id),
+            Source.created_at, Source.id, cursor, limit
         )
-        
-        set(cache_key, sources, ttl=120)
-        return sources
     except Exception as e:
         raise HTTPException(status_code=500, detail="Could not fetch sources from database")
+    set_next_cursor(response, next_cursor)
+    return sources
 
 # --- Ingestion Routes ---
 @app.post("/ingest-video")
 async def ingest_video(
     request: VideoIngestRequestSchema, 
     background_tasks: BackgroundTasks,
-    current_user: User = Depends(get_current_user),
+    current_user: PrincipalSchema = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     if current_user.credits <= 0:
@@ -306,9 +370,13 @@ async def ingest_video(
     if exists:
         return {"source_id": source_id, "status": "ready", "message": "Already exists"}
 
-    current_user.credits -= 1
-    db.add(current_user)
+    if deduct_credits(db, current_user.id) is None:
+        # Balance ran out concurrently; don't leave an unprocessed source behind
+        db.query(Source).filter(Source.id == source_id).delete()
+        db.commit()
+        return {"message": "You have 0 Credits left"}
     db.commit()
+    await invalidate_tag(f"user:{current_user.id}")
 
     background_tasks.add_task(ml_analysis_video, request.url, str(source_id))
 
@@ -321,7 +389,7 @@ async def ingest_video(
 async def ingest_document(
     background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    current_user: User = Depends(get_current_user),
+    current_user: PrincipalSchema = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     if current_user.credits <= 0:
@@ -341,9 +409,13 @@ async def ingest_document(
     if exists:
         return {"source_id": source_id, "status": "ready", "message": "Already exists"}
 
-    current_user.credits -= 1
-    db.add(current_user)
+    if deduct_credits(db, current_user.id) is None:
+        # Balance ran out concurrently; don't leave an unprocessed source behind
+        db.query(Source).filter(Source.id == source_id).delete()
+        db.commit()
+        return {"message": "You have 0 Credits left"}
     db.commit()
+    await invalidate_tag(f"user:{current_user.id}")
     file_bytes = await file.read()
 
     background_tasks.add_task(ml_analysis_document, file_bytes, file.filename, str(source_id))
@@ -357,158 +429,225 @@ async def ingest_document(
 # --- History Routes ---
 @app.delete("/reset-history")
 async def reset_history(
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db), 
-    current_user: User = Depends(get_current_user)
+    current_user: PrincipalSchema = Depends(get_current_user)
 ):
-    analyses = db.query(ResumeAnalysis).filter(ResumeAnalysis.user_id == current_user.id).all()
-    
-    for item in analyses:
-        try:
-            s3_client.delete_object(Bucket=get_settings.AWS_BUCKET_NAME, Key=item.s3_key)
-        except:
-            pass
-        db.delete(item)
-    
+    # One set-based delete; the stored files are removed after the response
+    s3_keys = delete_file_records(db, current_user.id)
     db.commit()
-    return {"status": "success"}
-@app.get("/history", response_model=List[AnalysisResponseSchema])
-async def get_history(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    history = db.query(ResumeAnalysis).filter(
-        ResumeAnalysis.user_id == current_user.id
-    ).order_by(ResumeAnalysis.created_at.desc()).all()
-    
+    mark_stale()
+    await invalidate_tag(f"user:{current_user.id}")
+
+    background_tasks.add_task(delete_s3_objects, s3_keys)
+    return {"status": "success", "deleted": len(s3_keys)}
+@app.get("/history", response_model=List[AnalysisResponseSchema], dependencies=[Depends(conditional_get)])
+async def get_history(
+    response: Response,
+    page: Tuple[int, Optional[str]] = Depends(page_params),
+    current_user: PrincipalSchema = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    limit, cursor = page
+    history, next_cursor = paginate(
+        db.query(ResumeAnalysis).filter(ResumeAnalysis.user_id == current_user.id),
+        ResumeAnalysis.created_at, ResumeAnalysis.id, cursor, limit
+    )
+    set_next_cursor(response, next_cursor)
     return history
 
+@app.get("/history/search", response_model=List[AnalysisResponseSchema], response_model_exclude_unset=True)
+async def search_history(
+    status: Optional[List[str]] = Query(None),
+    min_score: Optional[float] = None,
+    max_score: Optional[float] = None,
+    skills: Optional[List[str]] = Query(None),
+    info: Optional[List[str]] = Query(None),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    include_details: bool = False,
+    current_user: PrincipalSchema = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Top-k analyses by match_score. `skills` must all be listed in
+    candidate_info.skills; `info` takes key:value pairs matched against other
+    candidate_info fields. details/candidate_info are returned only with include_details.
+    """
+    try:
+        statuses = [AnalysisStatus(s) for s in status] if status else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid status filter")
+    candidate_filters = {}
+    for pair in info or []:
+        key, sep, value = pair.partition(":")
+        if not sep or not key:
+            raise HTTPException(status_code=400, detail="info filters must look like key:value")
+        try:
+            candidate_filters[key] = json.loads(value)
+        except ValueError:
+            candidate_filters[key] = value
+    if skills:
+        candidate_filters["skills"] = skills
+    return search_analyses(
+        db, current_user.id,
+        statuses=statuses, min_score=min_score, max_score=max_score,
+        candidate_filters=candidate_filters, limit=limit, include_details=include_details
+    )
+
 # --- Chat & Conversation Routes ---
+class ClientDisconnected(Exception):
+    pass
+
+async def await_unless_disconnected(request: Request, coro, poll_interval: float = 0.5):
+    """Await coro, cancelling it (and its in-flight HTTP call) if the client goes away."""
+    task = asyncio.create_task(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+
 @app.post("/chat")
 async def chat(
     data: ChatRequestSchema, 
+    request: Request,
+    response: Response,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: PrincipalSchema = Depends(get_current_user)
 ):
     
     if current_user.credits <= 0:
         raise HTTPException(status_code=402, detail="Insufficient credits.")
 
+    conv_id = None
+    if data.conversation_id:
+        try:
+            conv_id = uuid.UUID(str(data.conversation_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid conversation ID format")
+
+    # No DB transaction is held across ML calls: each read ends its own
+    # transaction and everything is persisted in one short write at the end.
+    asked_at = datetime.now(timezone.utc)
+    timings = {}
+    started = stage = perf_counter()
     try:
-        conversation = None
-        if data.conversation_id:
-            try:
-                conv_id = uuid.UUID(str(data.conversation_id))
-                conversation = db.query(Conversation).filter(
-                    Conversation.id == conv_id,
-                    Conversation.user_id == current_user.id
-                ).first()
-            except ValueError:
-                raise HTTPException(status_code=400, detail="Invalid conversation ID format")
-
-        if not conversation:
-            title = (data.question[:27] + "...") if len(data.question) > 30 else data.question
-            conversation = Conversation(title=title, user_id=current_user.id)
-            db.add(conversation)
-            db.flush() 
-        
-        db.add(ChatMessage(conversation_id=conversation.id, role="user", content=data.question))
-
         async with httpx.AsyncClient() as client:
+            # Vectorize while the conversation is resolved on a worker thread
+            vector_task = asyncio.create_task(ml_get_vector(client, data.question))
             try:
-                v_resp = await client.post(
-                    f"{get_settings.ML_SERVER_URL}/get-vector", 
-                    json={"text": data.question},
-                    timeout=20.0 
-                )
-                v_resp.raise_for_status()
-                query_vector = v_resp.json().get("vector")
+                conversation_id = await run_in_threadpool(find_conversation_id, db, conv_id, current_user.id)
+                timings["db_lookup"], stage = perf_counter() - stage, perf_counter()
+                query_vector = await vector_task
             except Exception as e:
+                vector_task.cancel()
+                if isinstance(e, HTTPException):
+                    raise
                 print(f"Vectorization Error: {str(e)}")
                 raise HTTPException(status_code=502, detail="Failed to vectorize question.")
+            timings["vectorize"], stage = perf_counter() - stage, perf_counter()
 
-            chunks = (
-                db.query(SourceChunk)
-                .join(Source, SourceChunk.source_id == Source.id)
-                .filter(Source.user_id == current_user.id)
-                .order_by(SourceChunk.embedding.cosine_distance(query_vector))
-                .limit(5)
-                .all()
+            contents = await run_in_threadpool(
+                search_chunk_contents, db, current_user.id, query_vector,
+                top_sources=get_settings.CHAT_TOP_SOURCES, source_ids=data.source_ids
             )
+            timings["search"], stage = perf_counter() - stage, perf_counter()
 
-            context_text = "\n\n".join([c.content for c in chunks]) if chunks else ""
-
+            request_id = str(uuid.uuid4())
             try:
-                ai_resp = await client.post(
-                    f"{get_settings.ML_SERVER_URL}/generate-answer", 
-                    json={
-                        "question": data.question,
-                        "context": context_text
-                    },
-                    timeout=90.0
+                answer_text = await await_unless_disconnected(
+                    request, ml_generate_answer(client, data.question, "\n\n".join(contents), request_id)
                 )
-                ai_resp.raise_for_status()
-                resp_data = ai_resp.json()
-                answer_text = resp_data.get("answer", "I couldn't process that.")
+            except ClientDisconnected:
+                if get_settings.ML_CANCEL_ON_DISCONNECT:
+                    background_tasks.add_task(ml_cancel_generation, request_id)
+                raise
+            except HTTPException:
+                raise
             except Exception as e:
                 print(f"Generation Error: {str(e)}")
                 raise HTTPException(status_code=502, detail="ML Model failed to respond.")
+            timings["generate"], stage = perf_counter() - stage, perf_counter()
 
-        db.add(ChatMessage(conversation_id=conversation.id, role="assistant", content=answer_text))
-        current_user.credits -= 1
-        db.commit() 
+        title = (data.question[:27] + "...") if len(data.question) > 30 else data.question
+        conversation_id = await run_in_threadpool(
+            save_chat_exchange, db, current_user.id, conversation_id, title, data.question, answer_text, asked_at
+        )
+        if conversation_id is None:
+            raise HTTPException(status_code=402, detail="Insufficient credits.")
+        timings["persist"] = perf_counter() - stage
+        timings["total"] = perf_counter() - started
         
-        delete(f"conversations:{current_user.id}")
-        delete(f"messages:{conversation.id}")
-        delete(f"user:{current_user.email}")
+        await invalidate_tag(f"user:{current_user.id}")
+
+        response.headers["Server-Timing"] = ", ".join(f"{name};dur={secs * 1000:.1f}" for name, secs in timings.items())
+        logger.info("chat timings (ms): " + " ".join(f"{name}={secs * 1000:.1f}" for name, secs in timings.items()))
 
         return {
             "answer": answer_text,
-            "conversation_id": str(conversation.id),
-            "context_used": len(chunks) > 0 
+            "conversation_id": str(conversation_id),
+            "context_used": len(contents) > 0 
         }
             
     except HTTPException:
         db.rollback()
         raise
+    except ClientDisconnected:
+        # Nothing was written yet; drop the exchange and don't charge for it
+        db.rollback()
+        logger.info(f"chat cancelled: client disconnected after {(perf_counter() - started) * 1000:.0f}ms")
+        return Response(status_code=499)
     except Exception as e:
         db.rollback()
         print(f"Chat Route Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
-@app.get("/conversations")
+@app.get("/conversations", response_model=List[ConversationSchema], dependencies=[Depends(conditional_get)])
+@cache_response(List[ConversationSchema], ttl=60, key_prefix="conversations")
 async def get_conversations(
     request: Request,
+    response: Response,
+    page: Tuple[int, Optional[str]] = Depends(page_params),
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: PrincipalSchema = Depends(get_current_user),
 ):
-    cache_key = f"conversations:{current_user.id}"
-    cached = get(cache_key)
-    if cached:
-        return cached
-    
-    conversations = (
-        db.query(Conversation)
-        .filter(Conversation.user_id == current_user.id)
-        .order_by(Conversation.created_at.desc())
-        .all()
+    limit, cursor = page
+    conversations, next_cursor = paginate(
+        db.query(Conversation).filter(Conversation.user_id == current_user.id),
+        Conversation.created_at, Conversation.id, cursor, limit
     )
-    
-    set(cache_key, conversations, ttl=60)
+    set_next_cursor(response, next_cursor)
     return conversations
 
 
-@app.get("/conversations/{conversation_id}/messages")
+@app.get("/conversations/{conversation_id}/messages", response_model=List[ChatMessageSchema])
+# Keyed by user too, so a cached page is never served to another account
+@cache_response(
+    List[ChatMessageSchema], ttl=30, key_prefix="messages",
+    tags=lambda current_user, conversation_id, **_: [f"user:{current_user.id}", f"conversation:{conversation_id}"],
+)
 async def get_messages(
     conversation_id: str,
     request: Request,
+    response: Response,
+    page: Tuple[int, Optional[str]] = Depends(page_params),
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: PrincipalSchema = Depends(get_current_user),
 ):
     try:
         conv_uuid = uuid.UUID(conversation_id)
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid conversation ID format")
-    
-    cache_key = f"messages:{conversation_id}"
-    cached = get(cache_key)
-    if cached:
-        return cached
+    limit, cursor = page
     
     conversation = (
         db.query(Conversation)
@@ -521,14 +660,11 @@ async def get_messages(
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
-    messages = (
-        db.query(ChatMessage)
-        .filter(ChatMessage.conversation_id == conv_uuid)
-        .order_by(ChatMessage.created_at.asc())
-        .all()
+    messages, next_cursor = paginate(
+        db.query(ChatMessage).filter(ChatMessage.conversation_id == conv_uuid),
+        ChatMessage.created_at, ChatMessage.id, cursor, limit, ascending=True
     )
-    
-    set(cache_key, messages, ttl=30)
+    set_next_cursor(response, next_cursor)
     return messages
 
 # --- Service Routes ---
@@ -536,7 +672,7 @@ async def get_messages(
 async def get_folder(
     request_data: FolderDataSchema, 
     background_tasks: BackgroundTasks,
-    current_user: User = Depends(get_current_user)
+    current_user: PrincipalSchema = Depends(get_current_user)
 ):
     # #   background_tasks.add_task(ml_health_check)
     if current_user.credits == 0:
@@ -587,7 +723,7 @@ async def upload_files(
     files: list[UploadFile] = File(...),
     description: str = Form(...),
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: PrincipalSchema = Depends(get_current_user)
 ):
     #   background_tasks.add_task(ml_health_check)
     if current_user.credits == 0:
@@ -599,39 +735,43 @@ async def upload_files(
         s3_url, s3_key = await upload_to_s3(file, file.filename)
         create_file_record(db, current_user.id, file.filename, s3_key, file_id)
         background_tasks.add_task(ml_analysis_s3, str(file_id), s3_url, file.filename, description)
+    await invalidate_tag(f"user:{current_user.id}")
     
     return {"message": "Processing started"}
 
 # --- Misc Routes ---
 @app.post("/get-description")
-async def get_description(file: UploadFile = File(...),current_user: User = Depends(get_current_user),db: Session = Depends(get_db)):
+async def get_description(file: UploadFile = File(...),current_user: PrincipalSchema = Depends(get_current_user),db: Session = Depends(get_db)):
     if current_user.credits <= 0:
         raise HTTPException(status_code=402, detail="Insufficient credits.")
     content = await file.read()
-    current_user.credits -= 1
-    db.add(current_user)
+    if deduct_credits(db, current_user.id) is None:
+        raise HTTPException(status_code=402, detail="Insufficient credits.")
     db.commit()
+    await invalidate_tag(f"user:{current_user.id}")
     return {"description": extract.text(content, file.content_type)}
 @app.post("/deduct-credit")
-async def deduct_credit(current_user: User = Depends(get_current_user),db: Session = Depends(get_db)):
+async def deduct_credit(current_user: PrincipalSchema = Depends(get_current_user),db: Session = Depends(get_db)):
     if current_user.credits <= 0:
         raise HTTPException(status_code=402, detail="Insufficient credits.")
-    current_user.credits -= 1
-    db.add(current_user)
+    if deduct_credits(db, current_user.id) is None:
+        raise HTTPException(status_code=402, detail="Insufficient credits.")
     db.commit()
+    await invalidate_tag(f"user:{current_user.id}")
     return {"message": "Credit deducted"}
 
 @app.post("/file-to-text")
-async def get_file_text(file: UploadFile = File(...), current_user: User = Depends(get_current_user),db: Session = Depends(get_db)):
+async def get_file_text(file: UploadFile = File(...), current_user: PrincipalSchema = Depends(get_current_user),db: Session = Depends(get_db)):
     if current_user.credits <= 0:
         raise HTTPException(status_code=402, detail="Insufficient credits.")
     content = await file.read()
     text = extract.text(content, file.content_type)
     text = text.strip()
     text = text.lower()
-    current_user.credits -= 1
-    db.add(current_user)
+    if deduct_credits(db, current_user.id) is None:
+        raise HTTPException(status_code=402, detail="Insufficient credits.")
     db.commit()
+    await invalidate_tag(f"user:{current_user.id}")
     return {"text": text}
 @app.post("/feedback")
 async def create_feedback(
@@ -675,7 +815,7 @@ async def create_feedback(
 @app.get("/get-feedbacks")
 async def get_all_feedbacks(
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: PrincipalSchema = Depends(get_current_user)
 ):
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(
@@ -686,121 +826,68 @@ async def get_all_feedbacks(
     return feedbacks
 
 
+def export_params(
+    entities: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    user_id: Optional[uuid.UUID] = None,
+):
+    """Comma-separated entity types (default all), a created_at range and an owner."""
+    selected = tuple(e.strip() for e in entities.split(",") if e.strip()) if entities else ENTITIES
+    unknown = [e for e in selected if e not in ENTITIES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown entities: {', '.join(unknown)}")
+    return selected, {"since": since, "until": until, "user_id": user_id}
+
 @app.get("/admin/data")
 async def get_admin_data(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    params = Depends(export_params),
+    current_user: PrincipalSchema = Depends(get_current_user),
 ):
-    """Return all DB data for admin (role === admin)."""
+    """Return all DB data for admin (role === admin), streamed as one JSON document."""
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(
             status_code=403,
             detail="Access denied. Administrator privileges required",
         )
-    users = db.query(User).order_by(User.updated_at.desc()).all()
-    users_data = [
-        {
-            "id": str(u.id),
-            "email": u.email,
-            "credits": u.credits,
-            "role": u.role.value,
-            "updated_at": str(u.updated_at) if u.updated_at else None,
-            "linked_folder_ids": u.linked_folder_ids or [],
-            "processed_filenames": u.processed_filenames or [],
-        }
-        for u in users
-    ]
-    sources = db.query(Source).order_by(Source.created_at.desc()).all()
-    sources_data = [
-        {
-            "id": str(s.id),
-            "source_name": s.source_name,
-            "source_type": s.source_type,
-            "status": s.status.value if hasattr(s.status, "value") else str(s.status),
-            "unique_key": s.unique_key,
-            "user_id": str(s.user_id),
-            "created_at": str(s.created_at) if s.created_at else None,
-            "updated_at": str(s.updated_at) if s.updated_at else None,
-        }
-        for s in sources
-    ]
-    analyses = (
-        db.query(ResumeAnalysis)
-        .order_by(ResumeAnalysis.created_at.desc())
-        .all()
-    )
-    analyses_data = [
-        {
-            "id": str(a.id),
-            "user_id": str(a.user_id),
-            "filename": a.filename,
-            "s3_key": a.s3_key,
-            "status": a.status.value if hasattr(a.status, "value") else str(a.status),
-            "match_score": a.match_score,
-            "details": a.details,
-            "candidate_info": a.candidate_info,
-            "created_at": str(a.created_at) if a.created_at else None,
-            "updated_at": str(a.updated_at) if a.updated_at else None,
-        }
-        for a in analyses
-    ]
-    conversations = (
-        db.query(Conversation)
-        .order_by(Conversation.created_at.desc())
-        .all()
-    )
-    conversations_data = []
-    for c in conversations:
-        messages = (
-            db.query(ChatMessage)
-            .filter(ChatMessage.conversation_id == c.id)
-            .order_by(ChatMessage.created_at.asc())
-            .all()
-        )
-        conversations_data.append(
-            {
-                "id": str(c.id),
-                "user_id": str(c.user_id),
-                "title": c.title,
-                "created_at": str(c.created_at) if c.created_at else None,
-                "message_count": len(messages),
-                "messages": [
-                    {
-                        "id": str(m.id),
-                        "role": m.role,
-                        "content": m.content,
-                        "created_at": str(m.created_at) if m.created_at else None,
-                    }
-                    for m in messages
-                ],
-            }
+    entities, filters = params
+    return StreamingResponse(export_document(entities, **filters), media_type="application/json")
+
+@app.get("/admin/export")
+async def export_admin_data(
+    params = Depends(export_params),
+    current_user: PrincipalSchema = Depends(get_current_user),
+):
+    """Stream DB data for admin as NDJSON, one {"entity": ..., ...} object per line."""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(
+            status_code=403,
+            detail="Access denied. Administrator privileges required",
         )
-    feedbacks = db.query(Feedback).order_by(Feedback.created_at.desc()).all()
-    feedbacks_data = [
-        {
-            "id": str(f.id),
-            "email": f.email,
-            "category": f.category.value if hasattr(f.category, "value") else str(f.category),
-            "content": f.content,
-            "created_at": str(f.created_at) if f.created_at else None,
-        }
-        for f in feedbacks
-    ]
-    return {
-        "users": users_data,
-        "sources": sources_data,
-        "resume_analyses": analyses_data,
-        "conversations": conversations_data,
-        "feedbacks": feedbacks_data,
-    }
+    entities, filters = params
+    return StreamingResponse(export_ndjson(entities, **filters), media_type="application/x-ndjson")
 
 
+@app.get("/admin/stats")
+async def get_admin_stats(
+    days: int = Query(30, ge=1, le=365),
+    db: Session = Depends(get_db),
+    current_user: PrincipalSchema = Depends(get_current_user),
+):
+    """Dashboard totals served from rollups; never scans the base tables."""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(
+            status_code=403,
+            detail="Access denied. Administrator privileges required",
+        )
+    return await get_or_load(f"admin:stats:{days}", lambda: read_stats(db, days), ttl=30, stale_ttl=30)
+
 @app.post("/resolve-feedback")
 async def resolve_feedback(
     data: FeedbackResolveSchema,
     background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: PrincipalSchema = Depends(get_current_user),
 ):
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Access denied. Administrator privileges required.")
@@ -0,0 +1,215 @@
+"""
+Streaming admin export
+
+Every entity is read with a server-side cursor (``yield_per``) and turned into
+JSON as it arrives, so memory stays flat however large the tables are.
+Conversations and their messages come from one joined query, grouped on the
+fly. Runs on its own session because the response outlives the request scope.
+"""
+import json
+import uuid
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
+from sqlalchemy import select
+from app.db.connect import SessionLocal
+from app.db.models import User, Source, ResumeAnalysis, AnalysisHistory, Conversation, ChatMessage, Feedback
+
+ENTITIES = ("users", "sources", "resume_analyses", "analysis_history", "conversations", "feedbacks")
+BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return str(value) if value else None
+
+
+def _enum(value) -> Optional[str]:
+    return value.value if hasattr(value, "value") else str(value)
+
+
+def _user_record(u: User) -> dict:
+    return {
+        "id": str(u.id),
+        "email": u.email,
+        "credits": u.credits,
+        "role": u.role.value,
+        "updated_at": _iso(u.updated_at),
+        "linked_folder_ids": u.linked_folder_ids or [],
+    }
+
+
+def _source_record(s: Source) -> dict:
+    return {
+        "id": str(s.id),
+        "source_name": s.source_name,
+        "source_type": s.source_type,
+        "status": _enum(s.status),
+        "unique_key": s.unique_key,
+        "user_id": str(s.user_id),
+        "created_at": _iso(s.created_at),
+        "updated_at": _iso(s.updated_at),
+    }
+
+
+def _analysis_record(a: ResumeAnalysis) -> dict:
+    return {
+        "id": str(a.id),
+        "user_id": str(a.user_id),
+        "filename": a.filename,
+        "s3_key": a.s3_key,
+        "status": _enum(a.status),
+        "match_score": a.match_score,
+        "details": a.details,
+        "candidate_info": a.candidate_info,
+        "created_at": _iso(a.created_at),
+        "updated_at": _iso(a.updated_at),
+    }
+
+
+def _history_record(h: AnalysisHistory) -> dict:
+    return {
+        "id": h.id,
+        "user_id": str(h.user_id),
+        "analysis_id": str(h.analysis_id) if h.analysis_id else None,
+        "filename": h.filename,
+        "match_score": h.match_score,
+        "created_at": _iso(h.created_at),
+    }
+
+
+def _feedback_record(f: Feedback) -> dict:
+    return {
+        "id": str(f.id),
+        "email": f.email,
+        "category": _enum(f.category),
+        "content": f.content,
+        "created_at": _iso(f.created_at),
+    }
+
+
+def _in_range(query, column, since: Optional[datetime], until: Optional[datetime]):
+    if since is not None:
+        query = query.filter(column >= since)
+    if until is not None:
+        query = query.filter(column < until)
+    return query
+
+
+def _iter_conversations(query) -> Iterator[dict]:
+    """Group (conversation, message) rows, ordered by conversation, into records."""
+    current = None
+    for conversation, message in query:
+        if current is None or current["id"] != str(conversation.id):
+            if current is not None:
+                yield current
+            current = {
+                "id": str(conversation.id),
+                "user_id": str(conversation.user_id),
+                "title": conversation.title,
+                "created_at": _iso(conversation.created_at),
+                "message_count": 0,
+                "messages": [],
+            }
+        if message is not None:
+            current["message_count"] += 1
+            current["messages"].append({
+                "id": str(message.id),
+                "role": message.role,
+                "content": message.content,
+                "created_at": _iso(message.created_at),
+            })
+    if current is not None:
+        yield current
+
+
+def iter_entity(
+    db,
+    entity: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    user_id: Optional[uuid.UUID] = None,
+) -> Iterator[dict]:
+    """Records of one entity type, newest first, optionally for one user and time range."""
+    if entity == "users":
+        query = _in_range(db.query(User), User.updated_at, since, until)
+        if user_id is not None:
+            query = query.filter(User.id == user_id)
+        query = query.order_by(User.updated_at.desc())
+        return map(_user_record, query.yield_per(BATCH_SIZE))
+    if entity == "sources":
+        query = _in_range(db.query(Source), Source.created_at, since, until)
+        if user_id is not None:
+            query = query.filter(Source.user_id == user_id)
+        query = query.order_by(Source.created_at.desc())
+        return map(_source_record, query.yield_per(BATCH_SIZE))
+    if entity == "resume_analyses":
+        query = _in_range(db.query(ResumeAnalysis), ResumeAnalysis.created_at, since, until)
+        if user_id is not None:
+            query = query.filter(ResumeAnalysis.user_id == user_id)
+        query = query.order_by(ResumeAnalysis.created_at.desc())
+        return map(_analysis_record, query.yield_per(BATCH_SIZE))
+    if entity == "analysis_history":
+        query = _in_range(db.query(AnalysisHistory), AnalysisHistory.created_at, since, until)
+        if user_id is not None:
+            query = query.filter(AnalysisHistory.user_id == user_id)
+        query = query.order_by(AnalysisHistory.created_at.desc())
+        return map(_history_record, query.yield_per(BATCH_SIZE))
+    if entity == "conversations":
+        query = _in_range(
+            db.query(Conversation, ChatMessage).outerjoin(ChatMessage, ChatMessage.conversation_id == Conversation.id),
+            Conversation.created_at, since, until,
+        )
+        if user_id is not None:
+            query = query.filter(Conversation.user_id == user_id)
+        query = query.order_by(Conversation.created_at.desc(), Conversation.id, ChatMessage.created_at.asc())
+        return _iter_conversations(query.yield_per(BATCH_SIZE))
+    if entity == "feedbacks":
+        query = _in_range(db.query(Feedback), Feedback.created_at, since, until)
+        if user_id is not None:
+            query = query.filter(Feedback.email == select(User.email).where(User.id == user_id).scalar_subquery())
+        query = query.order_by(Feedback.created_at.desc())
+        return map(_feedback_record, query.yield_per(BATCH_SIZE))
+    raise ValueError(f"Unknown entity: {entity}")
+
+
+def _buffered(parts: Iterable[str]) -> Iterator[bytes]:
+    """Coalesce many small JSON fragments into ~64KB response chunks."""
+    buffer, size = [], 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def export_ndjson(entities: Iterable[str], **filters) -> Iterator[bytes]:
+    """One JSON object per line, tagged with its entity type."""
+    def lines():
+        db = SessionLocal()
+        try:
+            for entity in entities:
+                for record in iter_entity(db, entity, **filters):
+                    yield json.dumps({"entity": entity, **record}, default=str) + "\n"
+        finally:
+            db.close()
+    return _buffered(lines())
+
+
+def export_document(entities: Iterable[str], **filters) -> Iterator[bytes]:
+    """The legacy ``{"users": [...], ...}`` document, streamed."""
+    def parts():
+        db = SessionLocal()
+        try:
+            yield "{"
+            for i, entity in enumerate(entities):
+                yield f'{", " if i else ""}"{entity}": ['
+                for j, record in enumerate(iter_entity(db, entity, **filters)):
+                    yield (", " if j else "") + json.dumps(record, default=str)
+                yield "]"
+            yield "}"
+        finally:
+            db.close()
+    return _buffered(parts())
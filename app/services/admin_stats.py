@@ -0,0 +1,137 @@
+"""
+Admin dashboard statistics
+
+Event totals (credits spent, chat messages) are added to sharded daily
+counters inside the transaction that caused them. State breakdowns (users,
+sources by status, analyses by score band) live in materialized views that a
+background task refreshes shortly after write paths mark them stale, and on a
+fixed schedule otherwise. Reading the dashboard never scans the base tables.
+"""
+import random
+import asyncio
+import logging
+from time import monotonic
+from typing import Optional
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+from app.config import settings
+from app.db.connect import engine
+from app.db.models import StatCounter, ADMIN_STATS_VIEWS
+
+get_settings = settings()
+logger = logging.getLogger(__name__)
+
+CREDITS_SPENT = "credits_spent"
+MESSAGES = "messages"
+COUNTER_SHARDS = 16
+# pg_advisory lock id so only one worker refreshes the views at a time
+REFRESH_LOCK_ID = 4401
+
+_stale = False
+_refresher: Optional[asyncio.Task] = None
+
+
+def bump_stat(db: Session, metric: str, amount: int = 1):
+    """Add to today's counter for `metric`; the caller commits."""
+    stmt = insert(StatCounter).values(
+        metric=metric, day=func.current_date(), shard=random.randrange(COUNTER_SHARDS), value=amount
+    )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[StatCounter.metric, StatCounter.day, StatCounter.shard],
+        set_={"value": StatCounter.value + stmt.excluded.value},
+    ))
+
+
+def mark_stale():
+    """Ask for the rollup views to be refreshed on the next tick."""
+    global _stale
+    _stale = True
+
+
+def refresh_views() -> bool:
+    """Refresh every rollup view; returns False if another worker holds the lock."""
+    with engine.begin() as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": REFRESH_LOCK_ID}).scalar():
+            return False
+        for name in ADMIN_STATS_VIEWS:
+            conn.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {name}"))
+    return True
+
+
+async def _refresh_loop(interval: float, max_age: float):
+    global _stale
+    refreshed_at = monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        if not _stale and monotonic() - refreshed_at < max_age:
+            continue
+        _stale = False
+        try:
+            await asyncio.to_thread(refresh_views)
+            refreshed_at = monotonic()
+        except Exception as e:
+            logger.warning(f"Admin stats refresh failed: {e}")
+
+
+async def start_stats_refresher():
+    global _refresher
+    if _refresher is None:
+        _refresher = asyncio.create_task(_refresh_loop(
+            get_settings.ADMIN_STATS_REFRESH_SECONDS, get_settings.ADMIN_STATS_MAX_AGE_SECONDS
+        ))
+
+
+async def stop_stats_refresher():
+    global _refresher
+    if _refresher is not None:
+        _refresher.cancel()
+        try:
+            await _refresher
+        except asyncio.CancelledError:
+            pass
+        _refresher = None
+
+
+def read_stats(db: Session, days: int = 30) -> dict:
+    """Dashboard totals from the rollups and the last `days` days of counters."""
+    try:
+        users = db.execute(text(
+            "SELECT users, admins, credits_outstanding FROM admin_stats_users"
+        )).mappings().first() or {}
+        sources = db.execute(text(
+            "SELECT status, source_type, count FROM admin_stats_sources ORDER BY status, source_type"
+        )).mappings().all()
+        analyses = db.execute(text(
+            "SELECT status, score_band, count FROM admin_stats_analyses ORDER BY status, score_band"
+        )).mappings().all()
+        counters = (
+            db.query(StatCounter.metric, StatCounter.day, func.sum(StatCounter.value))
+            .filter(StatCounter.day > func.current_date() - days)
+            .group_by(StatCounter.metric, StatCounter.day)
+            .order_by(StatCounter.day)
+            .all()
+        )
+        totals = dict(
+            db.query(StatCounter.metric, func.sum(StatCounter.value)).group_by(StatCounter.metric).all()
+        )
+    finally:
+        db.rollback()
+
+    daily = {CREDITS_SPENT: [], MESSAGES: []}
+    for metric, day, value in counters:
+        daily.setdefault(metric, []).append({"day": day.isoformat(), "count": int(value)})
+    return {
+        "users": {
+            "total": users.get("users", 0),
+            "admins": users.get("admins", 0),
+            "credits_outstanding": int(users.get("credits_outstanding", 0)),
+        },
+        "credits_spent": {"total": int(totals.get(CREDITS_SPENT, 0)), "per_day": daily[CREDITS_SPENT]},
+        "messages": {"total": int(totals.get(MESSAGES, 0)), "per_day": daily[MESSAGES]},
+        "sources_by_status": [dict(row) for row in sources],
+        "analyses_by_score_band": [
+            {"status": row["status"], "band": f"{row['score_band']}-{row['score_band'] + 10}", "count": row["count"]}
+            for row in analyses
+        ],
+    }
@@ -0,0 +1,64 @@
+"""
+Analysis history retention
+
+History entries are only ever inserted; keeping each user's log to the newest
+ANALYSIS_HISTORY_KEEP entries is done here, in small batches on a timer, so
+the write path never reads or rewrites what is already there.
+"""
+import asyncio
+import logging
+from typing import Optional
+from app.config import settings
+from app.db.connect import SessionLocal
+from app.db.cruds import trim_analysis_history
+
+get_settings = settings()
+logger = logging.getLogger(__name__)
+
+TRIM_BATCH_SIZE = 10000
+
+_trimmer: Optional[asyncio.Task] = None
+
+
+def trim_history(keep: int) -> int:
+    """Trim every user's history down to `keep` entries; returns how many were deleted."""
+    db = SessionLocal()
+    try:
+        total = 0
+        while True:
+            deleted = trim_analysis_history(db, keep, TRIM_BATCH_SIZE)
+            total += deleted
+            if deleted < TRIM_BATCH_SIZE:
+                return total
+    finally:
+        db.close()
+
+
+async def _trim_loop(interval: float, keep: int):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            deleted = await asyncio.to_thread(trim_history, keep)
+            if deleted:
+                logger.info(f"Trimmed {deleted} analysis history entries")
+        except Exception as e:
+            logger.warning(f"Analysis history trim failed: {e}")
+
+
+async def start_history_trimmer():
+    global _trimmer
+    if _trimmer is None:
+        _trimmer = asyncio.create_task(_trim_loop(
+            get_settings.ANALYSIS_HISTORY_TRIM_SECONDS, get_settings.ANALYSIS_HISTORY_KEEP
+        ))
+
+
+async def stop_history_trimmer():
+    global _trimmer
+    if _trimmer is not None:
+        _trimmer.cancel()
+        try:
+            await _trimmer
+        except asyncio.CancelledError:
+            pass
+        _trimmer = None
@@ -1,16 +1,181 @@
 import httpx
 import asyncio
 import logging
+from collections import Counter
 import app.services.extract as extract
 
 from app.db.connect import SessionLocal
 from app.db.models import AnalysisStatus
 from app.db.cruds import update_file_record, create_file_record, update_source_status
 from app.config import settings
+from app.lib.cache import invalidate_tag
+from app.lib.aws_client import delete_s3_objects
+from app.lib.concurrency_limit import AdaptiveConcurrencyLimiter, ConcurrencyLimitExceeded
+from app.lib.hedging import Hedger, RetryBudget
 
 logger = logging.getLogger(__name__)
 get_settings = settings()
 
+# Outcomes of /generate-answer calls in this process: completed, cancelled, failed
+generation_counts = Counter()
+
+def _is_ml_overload(exc: BaseException) -> bool:
+    """Timeouts, connection errors, 429s and 5xxs mean the ML server is struggling."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+def _ml_limiter(name: str) -> AdaptiveConcurrencyLimiter:
+    return AdaptiveConcurrencyLimiter(
+        name,
+        initial_limit=get_settings.ML_CONCURRENCY_INITIAL,
+        max_limit=get_settings.ML_CONCURRENCY_MAX,
+        is_overload=_is_ml_overload,
+    )
+
+# Endpoints with very different latencies get separate limits so a slow
+# analysis doesn't read as an overloaded embedding call
+ml_limiters = {
+    "vector": _ml_limiter("ML embedding"),
+    "generate": _ml_limiter("ML generation"),
+    "handoff": _ml_limiter("ML ingestion"),
+    "analysis": _ml_limiter("ML analysis"),
+}
+
+def _ml_hedger(budget: RetryBudget) -> Hedger:
+    return Hedger(
+        budget,
+        percentile=get_settings.ML_HEDGE_PERCENTILE,
+        min_delay=get_settings.ML_HEDGE_MIN_DELAY_MS / 1000,
+        hedge=get_settings.ML_HEDGE_PERCENTILE > 0,
+        is_retryable=_is_ml_overload,
+    )
+
+# Only idempotent calls are hedged or retried; they share one budget
+_ml_retry_budget = RetryBudget(ratio=get_settings.ML_RETRY_BUDGET_RATIO)
+ml_hedgers = {
+    "vector": _ml_hedger(_ml_retry_budget),
+    "vectors": _ml_hedger(_ml_retry_budget),
+}
+
+class EmbeddingCoalescer:
+    """
+    Micro-batches concurrent question embeddings
+
+    Texts are collected for up to `max_wait` seconds or `max_batch_size` items,
+    sent as one /get-vectors request, and each caller's future resolves with
+    its own vector. If the ML server has no /get-vectors, that batch and every
+    later call go out as single /get-vector requests.
+    """
+
+    def __init__(self, max_batch_size: int, max_wait: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self._client = None
+        self.batch_endpoint = True
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch_size > 1 and self.batch_endpoint
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # One pooled client for every batch: setting one up per call costs
+        # more than the forward pass batching saves
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient()
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def embed(self, text: str) -> list:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        # Callers that gave up while waiting don't need a vector
+        batch = [(text, future) for text, future in batch if not future.done()]
+        if not batch:
+            return
+        texts = [text for text, _ in batch]
+        try:
+            vectors = await ml_hedgers["vectors"](lambda: self._post(texts))
+            if len(vectors) != len(batch):
+                raise ValueError(f"Expected {len(batch)} vectors, got {len(vectors)}")
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                self._fail(batch, e)
+                return
+            logger.warning("ML server has no /get-vectors; embedding questions one at a time")
+            self.batch_endpoint = False
+            await self._send_singly(batch)
+            return
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+    @staticmethod
+    def _fail(batch, exc: BaseException):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exc)
+
+    async def _send_singly(self, batch):
+        client = self._get_client()
+
+        async def send_one(text, future):
+            try:
+                vector = await ml_hedgers["vector"](lambda: _post_vector(client, text))
+            except Exception as e:
+                self._fail([(text, future)], e)
+                return
+            if not future.done():
+                future.set_result(vector)
+
+        await asyncio.gather(*(send_one(text, future) for text, future in batch))
+
+    async def _post(self, texts: list) -> list:
+        async with ml_limiters["vector"].slot():
+            resp = await self._get_client().post(
+                f"{get_settings.ML_SERVER_URL}/get-vectors",
+                json={"texts": texts},
+                timeout=20.0
+            )
+            resp.raise_for_status()
+        return resp.json().get("vectors") or []
+
+_embedding_coalescer = EmbeddingCoalescer(
+    max_batch_size=get_settings.ML_VECTOR_BATCH_SIZE,
+    max_wait=get_settings.ML_VECTOR_BATCH_MAX_WAIT_MS / 1000,
+)
+
+async def close_ml_clients():
+    await _embedding_coalescer.close()
+
 async def ml_health_check(max_retries=5, delay=5):
     async with httpx.AsyncClient() as client:
         for i in range(max_retries):
@@ -24,6 +189,67 @@ async def ml_health_check(max_retries=5, delay=5):
             await asyncio.sleep(delay)
     return False
 
+async def _post_vector(client: httpx.AsyncClient, text: str) -> list:
+    async with ml_limiters["vector"].slot():
+        resp = await client.post(
+            f"{get_settings.ML_SERVER_URL}/get-vector", 
+            json={"text": text},
+            timeout=20.0 
+        )
+        resp.raise_for_status()
+    return resp.json().get("vector")
+
+async def ml_get_vector(client: httpx.AsyncClient, text: str) -> list:
+    if _embedding_coalescer.enabled:
+        return await _embedding_coalescer.embed(text)
+    return await ml_hedgers["vector"](lambda: _post_vector(client, text))
+
+async def ml_generate_answer(client: httpx.AsyncClient, question: str, context: str, request_id: str = None) -> str:
+    try:
+        async with ml_limiters["generate"].slot():
+            resp = await client.post(
+                f"{get_settings.ML_SERVER_URL}/generate-answer", 
+                json={
+                    "question": question,
+                    "context": context
+                },
+                headers={"X-Request-ID": request_id} if request_id else None,
+                timeout=90.0
+            )
+            resp.raise_for_status()
+    except ConcurrencyLimitExceeded:
+        raise
+    except asyncio.CancelledError:
+        generation_counts["cancelled"] += 1
+        raise
+    except Exception:
+        generation_counts["failed"] += 1
+        raise
+    generation_counts["completed"] += 1
+    return resp.json().get("answer", "I couldn't process that.")
+
+async def ml_cancel_generation(request_id: str):
+    """Best-effort signal so the ML server can drop work nobody will read."""
+    try:
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            await client.post(
+                f"{get_settings.ML_SERVER_URL}/cancel-generation",
+                json={"request_id": request_id},
+                headers={"X-API-Key": get_settings.ML_SERVER_API_KEY}
+            )
+    except Exception as e:
+        logger.warning(f"Failed to send cancel for generation {request_id}: {e}")
+
+async def _fail_analysis(db, file_id: str):
+    record = update_file_record(db, file_id, status=AnalysisStatus.FAILED)
+    if record:
+        await invalidate_tag(f"user:{record.user_id}")
+
+async def _set_source_status(db, source_id: str, status: AnalysisStatus):
+    source = update_source_status(db, source_id, status=status)
+    if source:
+        await invalidate_tag(f"user:{source.user_id}")
+
 async def ml_analysis_document(file_content: bytes, filename: str, source_id: str):
     db = SessionLocal()
     try:
@@ -40,24 +266,25 @@ async def ml_analysis_document(file_content: bytes, filename: str, source_id: st
 
             text = extract.text(content=file_content, mime_type=m_type)
 
-            resp = await client.post(
-                target_url, 
-                json={
-                    "text": text, 
-                    "filename": filename,
-                    "source_id": source_id
-                },
-                headers=headers
-            )
+            async with ml_limiters["handoff"].slot(wait=True):
+                resp = await client.post(
+                    target_url, 
+                    json={
+                        "text": text, 
+                        "filename": filename,
+                        "source_id": source_id
+                    },
+                    headers=headers
+                )
             
             if resp.status_code != 200:
-                update_source_status(db, source_id, status=AnalysisStatus.FAILED)
+                await _set_source_status(db, source_id, AnalysisStatus.FAILED)
             else:
-                update_source_status(db, source_id, status=AnalysisStatus.PROCESSING)
+                await _set_source_status(db, source_id, AnalysisStatus.PROCESSING)
                 
     except Exception as e:
         logger.error(f"Failed to hand off document to ML Server: {e}")
-        update_source_status(db, source_id, status=AnalysisStatus.FAILED)
+        await _set_source_status(db, source_id, AnalysisStatus.FAILED)
     finally:
         db.close()
 
@@ -68,21 +295,22 @@ async def ml_analysis_video(video_url: str, source_id: str):
             target_url = f"{get_settings.ML_SERVER_URL}/analyze-video"
             headers = {"X-API-Key": get_settings.ML_SERVER_API_KEY}
             
-            resp = await client.post(
-                target_url, 
-                json={
-                    "url": video_url, 
-                    "source_id": source_id
-                },
-                headers=headers
-            )
+            async with ml_limiters["handoff"].slot(wait=True):
+                resp = await client.post(
+                    target_url, 
+                    json={
+                        "url": video_url, 
+                        "source_id": source_id
+                    },
+                    headers=headers
+                )
             
             if resp.status_code != 200:
-                update_source_status(db, source_id, status=AnalysisStatus.FAILED)
+                await _set_source_status(db, source_id, AnalysisStatus.FAILED)
                 
     except Exception as e:
         logger.error(f"Failed to hand off video to ML Server: {e}")
-        update_source_status(db, source_id, status=AnalysisStatus.FAILED)
+        await _set_source_status(db, source_id, AnalysisStatus.FAILED)
     finally:
         db.close()
 
@@ -105,6 +333,7 @@ async def ml_analysis_drive(user_id: str, files: list, google_token: str, descri
                     filename=file_info.get("name"), 
                     s3_key=None 
                 )
+                await invalidate_tag(f"user:{user_id}")
                 
                 try:
                     payload = {
@@ -116,14 +345,15 @@ async def ml_analysis_drive(user_id: str, files: list, google_token: str, descri
                     }
 
                     headers = {"X-API-Key": get_settings.ML_SERVER_API_KEY}
-                    resp = await client.post(target_url,  json=payload, headers=headers)
+                    async with ml_limiters["analysis"].slot(wait=True):
+                        resp = await client.post(target_url,  json=payload, headers=headers)
                     
                     if resp.status_code == 200:
                         ml_data = resp.json()
                         if ml_data.get("status") == "failed":
                             error_msg = ml_data.get("error", "Processing failed")
                             logger.error(f"ML processing failed for {file_info.get('name')}: {error_msg}")
-                            update_file_record(db, file_id=str(record.id), status=AnalysisStatus.FAILED)
+                            await _fail_analysis(db, str(record.id))
                         else:
                             update_file_record(
                                 db, 
@@ -133,14 +363,15 @@ async def ml_analysis_drive(user_id: str, files: list, google_token: str, descri
                                 details=ml_data.get("analysis_details", {}),
                                 candidate_info=ml_data.get("candidate_info", {})
                             )
+                            await invalidate_tag(f"user:{user_id}")
                     else:
                         error_text = resp.text[:200] if hasattr(resp, 'text') else "Unknown error"
                         logger.error(f"ML Server error for {file_info.get('name')}: {resp.status_code} - {error_text}")
-                        update_file_record(db, file_id=str(record.id), status=AnalysisStatus.FAILED)
+                        await _fail_analysis(db, str(record.id))
                         
                 except Exception as e:
                     logger.error(f"Error processing {file_info.get('name')}: {e}")
-                    update_file_record(db, file_id=str(record.id), status=AnalysisStatus.FAILED)
+                    await _fail_analysis(db, str(record.id))
     finally:
         db.close()
 
@@ -150,43 +381,52 @@ async def ml_analysis_s3(file_id: str, s3_url: str, filename: str, description:
     db = SessionLocal()
     try:
         if not is_awake:
-            update_file_record(db, file_id, status=AnalysisStatus.FAILED)
+            await _fail_analysis(db, file_id)
             return
 
         async with httpx.AsyncClient(timeout=120.0) as client:
             target_url = f"{get_settings.ML_SERVER_URL}/analyze-s3"
             headers = {"X-API-Key": get_settings.ML_SERVER_API_KEY}
-            resp = await client.post(
-                target_url, 
-                json={
-                    "filename": filename, 
-                    "file_url": s3_url,
-                    "description": description
-                },
-                timeout=120.0,
-                headers=headers
-            )
+            async with ml_limiters["analysis"].slot(wait=True):
+                resp = await client.post(
+                    target_url, 
+                    json={
+                        "filename": filename, 
+                        "file_url": s3_url,
+                        "description": description
+                    },
+                    timeout=120.0,
+                    headers=headers
+                )
             
             if resp.status_code == 200:
                 ml_data = resp.json()
                 if ml_data.get("status") == "failed":
                     error_msg = ml_data.get("error", "Processing failed")
                     logger.error(f"ML processing failed for {filename}: {error_msg}")
-                    update_file_record(db, file_id, status=AnalysisStatus.FAILED)
+                    await _fail_analysis(db, file_id)
                 else:
-                    update_file_record(
+                    record = update_file_record(
                         db, file_id, 
                         status=AnalysisStatus.COMPLETED, 
                         score=ml_data.get("match_score", 0),
                         details=ml_data.get("analysis_details", {}),
                         candidate_info=ml_data.get("candidate_info", {})
                     )
+                    if record:
+                        await invalidate_tag(f"user:{record.user_id}")
+                    if record and record.s3_key and get_settings.DELETE_S3_AFTER_PROCESSING:
+                        # The upload isn't needed once it has been analysed
+                        failed = await asyncio.to_thread(delete_s3_objects, [record.s3_key])
+                        if not failed:
+                            record.s3_key = None
+                            db.commit()
             else:
                 error_text = resp.text[:200] if hasattr(resp, 'text') else "Unknown error"
                 logger.error(f"ML Server error for {filename}: {resp.status_code} - {error_text}")
-                update_file_record(db, file_id, status=AnalysisStatus.FAILED)
+                await _fail_analysis(db, file_id)
     except Exception as e:
         logger.error(f"S3 ML Task Crash: {e}")
-        update_file_record(db, file_id, status=AnalysisStatus.FAILED)
+        await _fail_analysis(db, file_id)
     finally:
         db.close()
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""
+Question embedding throughput and latency, with and without coalescing
+
+Starts a fake ML server on localhost that runs one forward pass at a time,
+costing ``--pass-ms`` plus ``--text-ms`` per text (so batching amortises the
+fixed part, as on a GPU), then sends Poisson arrivals through
+``ml_get_vector`` at each offered rate, once per single /get-vector calls and
+once coalesced into /get-vectors batches. Reports completed requests/second
+and p50/p99 latency.
+
+Run from the repository root with the app's environment (.env) in place:
+
+    python -m benchmarks.embedding_coalescer --rates 100 200 400
+"""
+import socket
+import random
+import asyncio
+import argparse
+import threading
+from time import perf_counter, sleep
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from app.lib.hedging import RetryBudget
+import app.services.ml_process as ml_process
+
+
+def make_ml_server(pass_ms: float, text_ms: float) -> Starlette:
+    model = asyncio.Lock()
+
+    async def forward(count: int):
+        async with model:
+            await asyncio.sleep((pass_ms + text_ms * count) / 1000)
+
+    async def get_vector(request: Request):
+        await request.json()
+        await forward(1)
+        return JSONResponse({"vector": [0.0] * 768})
+
+    async def get_vectors(request: Request):
+        texts = (await request.json())["texts"]
+        await forward(len(texts))
+        return JSONResponse({"vectors": [[0.0] * 768 for _ in texts]})
+
+    return Starlette(routes=[
+        Route("/get-vector", get_vector, methods=["POST"]),
+        Route("/get-vectors", get_vectors, methods=["POST"]),
+    ])
+
+
+def start_ml_server(app: Starlette) -> str:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="critical"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        sleep(0.01)
+    return f"http://127.0.0.1:{port}"
+
+
+def reset_ml_clients(batch_size: int, max_wait: float):
+    """Fresh limiter, hedgers and coalescer so runs don't share learned state."""
+    ml_process.ml_limiters["vector"] = ml_process._ml_limiter("ML embedding")
+    budget = RetryBudget(ratio=ml_process.get_settings.ML_RETRY_BUDGET_RATIO)
+    ml_process.ml_hedgers["vector"] = ml_process._ml_hedger(budget)
+    ml_process.ml_hedgers["vectors"] = ml_process._ml_hedger(budget)
+    ml_process._embedding_coalescer = ml_process.EmbeddingCoalescer(batch_size, max_wait)
+
+
+async def run(rate: float, requests: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    latencies, failures = [], 0
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    async with httpx.AsyncClient(limits=limits) as client:
+        async def one(index: int):
+            nonlocal failures
+            started = perf_counter()
+            try:
+                await ml_process.ml_get_vector(client, f"question {index}")
+            except Exception:
+                failures += 1
+                return
+            latencies.append(perf_counter() - started)
+
+        tasks = []
+        started = perf_counter()
+        for index in range(requests):
+            tasks.append(asyncio.create_task(one(index)))
+            await asyncio.sleep(rng.expovariate(rate))
+        await asyncio.gather(*tasks)
+        elapsed = perf_counter() - started
+    latencies.sort()
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50": latencies[len(latencies) // 2] * 1000,
+        "p99": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "failures": failures,
+    }
+
+
+def main(args):
+    ml_process.get_settings.ML_SERVER_URL = start_ml_server(make_ml_server(args.pass_ms, args.text_ms))
+    configs = [("single", 1, 0.0), (f"{args.batch_size} / {args.max_wait_ms:g}ms", args.batch_size, args.max_wait_ms / 1000)]
+    print(f"{args.requests} requests per run; ML pass {args.pass_ms:g}ms + {args.text_ms:g}ms per text")
+    print(f"{'offered/s':>10}  {'batch / wait':<14}{'done/s':>8}{'p50 ms':>9}{'p99 ms':>9}  failed")
+    for rate in args.rates:
+        for label, batch_size, max_wait in configs:
+            reset_ml_clients(batch_size, max_wait)
+            result = asyncio.run(run(rate, args.requests, args.seed))
+            print(
+                f"{rate:>10g}  {label:<14}{result['rps']:>8.1f}{result['p50']:>9.1f}{result['p99']:>9.1f}"
+                f"  {result['failures']}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rates", type=float, nargs="+", default=[100, 200, 400])
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--pass-ms", type=float, default=4.0)
+    parser.add_argument("--text-ms", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,103 @@
+"""
+Requests/second through RateLimitMiddleware
+
+Drives the real middleware in front of a trivial ASGI app, in process and
+without sockets, for each algorithm against Redis and against the
+in-process fallback. Redis is ``--redis-url`` when given, otherwise an
+in-process fakeredis server (which measures the client and script path, not
+network latency). Every request is allowed, so this is the per-request cost
+of rate limiting; pass a small ``--calls`` to measure the 429 path instead.
+
+Run from the repository root with the app's environment (.env) in place:
+
+    python -m benchmarks.rate_limit_middleware --requests 20000
+"""
+import argparse
+import asyncio
+import uuid
+from time import perf_counter
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from app.lib import redis_pool
+from app.lib.auth_client import create_access_token
+from app.lib.rate_limit import GCRA, SLIDING_WINDOW, RateLimitMiddleware, RateLimitPolicy
+
+
+async def ok(request):
+    return PlainTextResponse("ok")
+
+
+def make_app(algorithm: str, calls: int) -> Starlette:
+    app = Starlette(routes=[Route("/{name}", ok)])
+    app.add_middleware(
+        RateLimitMiddleware, default=RateLimitPolicy(calls=calls, period=60), algorithm=algorithm
+    )
+    return app
+
+
+async def measure(app: Starlette, path: str, tokens, requests: int, concurrency: int) -> dict:
+    statuses = {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        async def worker(worker_id: int, count: int):
+            for i in range(count):
+                token = tokens[(worker_id + i * concurrency) % len(tokens)]
+                response = await client.get(path, headers={"Authorization": f"Bearer {token}"})
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        # Warm the token cache and load the Lua scripts before timing
+        await asyncio.gather(*(worker(w, 1) for w in range(min(concurrency, len(tokens)))))
+        statuses.clear()
+        per_worker = requests // concurrency
+        started = perf_counter()
+        await asyncio.gather(*(worker(w, per_worker) for w in range(concurrency)))
+        elapsed = perf_counter() - started
+    return {"rps": per_worker * concurrency / elapsed, "statuses": statuses}
+
+
+async def connect_redis(url: str):
+    if url:
+        redis_pool.get_settings.REDIS_URL = url
+        if not await redis_pool.init_redis():
+            raise SystemExit(f"Could not connect to {url}")
+        return "redis"
+    try:
+        import fakeredis
+    except ImportError:
+        return None
+    redis_pool._client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    return "fakeredis"
+
+
+async def main(args):
+    tokens = [create_access_token({"sub": f"bench-user-{i}"}) for i in range(args.users)]
+    backends = []
+    redis_name = await connect_redis(args.redis_url)
+    if redis_name:
+        backends.append(redis_name)
+    else:
+        print("fakeredis is not installed and no --redis-url given; measuring the fallback only")
+    backends.append("local")
+
+    print(f"{args.requests} requests, {args.concurrency} concurrent, {args.users} users, {args.calls} calls/60s")
+    print(f"{'algorithm':<16}{'store':<12}{'req/s':>10}  statuses")
+    for backend in backends:
+        if backend == "local":
+            await redis_pool.close_redis()
+            redis_pool._client = None
+        for algorithm in (GCRA, SLIDING_WINDOW):
+            # Keys are per path, so each algorithm and run starts with fresh state
+            path = f"/{algorithm}-{uuid.uuid4().hex[:8]}"
+            result = await measure(make_app(algorithm, args.calls), path, tokens, args.requests, args.concurrency)
+            print(f"{algorithm:<16}{backend:<12}{result['rps']:>10.0f}  {result['statuses']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--calls", type=int, default=10 ** 9, help="budget per user per minute")
+    parser.add_argument("--redis-url", default="", help="benchmark a real Redis instead of fakeredis")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,44 @@
+"""
+Admin stats migration
+Creates the stat_counters table and the rollup materialized views behind
+/admin/stats, and backfills the message counters from chat_messages.
+Credits spent before this migration were never recorded and start at zero.
+"""
+from sqlalchemy import create_engine, text
+from app.db.connect import get_settings
+from app.db.models import StatCounter, admin_stats_view_ddl
+
+def add_admin_stats():
+    """Create and backfill the admin stats rollups"""
+    engine = create_engine(get_settings.DATABASE_URL)
+    StatCounter.__table__.create(engine, checkfirst=True)
+
+    statements = [
+        *admin_stats_view_ddl(),
+        """
+        INSERT INTO stat_counters (metric, day, shard, value)
+        SELECT 'messages', created_at::date, 0, count(*)
+        FROM chat_messages
+        -- Only days before live counting started, so nothing is counted twice
+        WHERE created_at::date < (
+            SELECT COALESCE(MIN(day), CURRENT_DATE + 1) FROM stat_counters WHERE metric = 'messages'
+        )
+        GROUP BY created_at::date
+        ON CONFLICT (metric, day, shard) DO NOTHING;
+        """,
+    ]
+
+    with engine.connect() as conn:
+        for statement in statements:
+            try:
+                conn.execute(text(statement))
+                conn.commit()
+                print(f"✓ {' '.join(statement.split())[:60]}")
+            except Exception as e:
+                print(f"✗ Failed: {e}")
+                conn.rollback()
+
+    print("\nAdmin stats migration completed!")
+
+if __name__ == "__main__":
+    add_admin_stats()
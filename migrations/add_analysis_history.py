@@ -0,0 +1,44 @@
+"""
+Analysis history migration
+Creates the append-only analysis_history table, copies each user's
+processed_filenames into it (oldest first, so the newest get the latest
+timestamps) and drops the JSONB column from users.
+"""
+from sqlalchemy import create_engine, text
+from app.db.connect import get_settings
+from app.db.models import AnalysisHistory
+
+def add_analysis_history():
+    """Move processed filenames off the users row"""
+    engine = create_engine(get_settings.DATABASE_URL)
+    AnalysisHistory.__table__.create(engine, checkfirst=True)
+
+    statements = [
+        """
+        INSERT INTO analysis_history (user_id, filename, created_at)
+        SELECT u.id, f.filename, u.updated_at + f.position * interval '1 microsecond'
+        FROM users u
+        CROSS JOIN LATERAL jsonb_array_elements_text(
+            CASE WHEN jsonb_typeof(u.processed_filenames) = 'array' THEN u.processed_filenames ELSE '[]'::jsonb END
+        ) WITH ORDINALITY AS f(filename, position)
+        -- Skip users already moved, so the migration can be rerun
+        WHERE NOT EXISTS (SELECT 1 FROM analysis_history h WHERE h.user_id = u.id);
+        """,
+        "ALTER TABLE users DROP COLUMN IF EXISTS processed_filenames;",
+        "ANALYZE analysis_history;",
+    ]
+
+    with engine.connect() as conn:
+        for statement in statements:
+            try:
+                conn.execute(text(statement))
+                conn.commit()
+                print(f"✓ {' '.join(statement.split())[:60]}")
+            except Exception as e:
+                print(f"✗ Failed: {e}")
+                conn.rollback()
+
+    print("\nAnalysis history migration completed!")
+
+if __name__ == "__main__":
+    add_analysis_history()
@@ -10,6 +10,8 @@ def add_indexes():
     """Add database indexes for optimized queries"""
     engine = create_engine(get_settings.DATABASE_URL)
     
+    # List routes page by keyset on (created_at, id); these match that order
+    # (read backwards for ascending pages) so ties need no extra sort
     indexes = [
         # User table indexes
         "CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);",
@@ -17,7 +19,7 @@ def add_indexes():
         
         # Source table indexes
         "CREATE INDEX IF NOT EXISTS idx_sources_user_id ON sources(user_id);",
-        "CREATE INDEX IF NOT EXISTS idx_sources_user_id_created_at ON sources(user_id, created_at DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_sources_user_id_created_at_id ON sources(user_id, created_at DESC, id DESC);",
         "CREATE INDEX IF NOT EXISTS idx_sources_unique_key ON sources(unique_key);",
         "CREATE INDEX IF NOT EXISTS idx_sources_status ON sources(status);",
         
@@ -28,21 +30,33 @@ def add_indexes():
         
         # Conversation table indexes
         "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id);",
-        "CREATE INDEX IF NOT EXISTS idx_conversations_user_id_created_at ON conversations(user_id, created_at DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_id_created_at_id ON conversations(user_id, created_at DESC, id DESC);",
         
         # ChatMessage table indexes
         "CREATE INDEX IF NOT EXISTS idx_chat_messages_conversation_id ON chat_messages(conversation_id);",
-        "CREATE INDEX IF NOT EXISTS idx_chat_messages_conversation_id_created_at ON chat_messages(conversation_id, created_at ASC);",
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_conversation_id_created_at_id ON chat_messages(conversation_id, created_at DESC, id DESC);",
         
         # ResumeAnalysis table indexes
         "CREATE INDEX IF NOT EXISTS idx_resume_analyses_user_id ON resume_analyses(user_id);",
-        "CREATE INDEX IF NOT EXISTS idx_resume_analyses_user_id_created_at ON resume_analyses(user_id, created_at DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_resume_analyses_user_id_created_at_id ON resume_analyses(user_id, created_at DESC, id DESC);",
         "CREATE INDEX IF NOT EXISTS idx_resume_analyses_status ON resume_analyses(status);",
+        "CREATE INDEX IF NOT EXISTS idx_resume_analyses_user_id_match_score ON resume_analyses(user_id, match_score DESC NULLS LAST);",
+        # JSONB containment (@>) filters used by /history/search
+        "CREATE INDEX IF NOT EXISTS idx_resume_analyses_candidate_info ON resume_analyses USING gin (candidate_info jsonb_path_ops);",
+        "CREATE INDEX IF NOT EXISTS idx_resume_analyses_details ON resume_analyses USING gin (details jsonb_path_ops);",
         
         # Feedback table indexes
         "CREATE INDEX IF NOT EXISTS idx_feedbacks_created_at ON feedbacks(created_at DESC);",
         "CREATE INDEX IF NOT EXISTS idx_feedbacks_category ON feedbacks(category);",
     ]
+
+    # Replaced by the (created_at, id) keyset indexes above
+    superseded = [
+        "idx_sources_user_id_created_at",
+        "idx_conversations_user_id_created_at",
+        "idx_chat_messages_conversation_id_created_at",
+        "idx_resume_analyses_user_id_created_at",
+    ]
     
     with engine.connect() as conn:
         for index_sql in indexes:
@@ -53,6 +67,14 @@ def add_indexes():
             except Exception as e:
                 print(f"✗ Failed to create index: {e}")
                 conn.rollback()
+        for name in superseded:
+            try:
+                conn.execute(text(f"DROP INDEX IF EXISTS {name};"))
+                conn.commit()
+                print(f"✓ Dropped index: {name}")
+            except Exception as e:
+                print(f"✗ Failed to drop index: {e}")
+                conn.rollback()
     
     print("\nIndex creation completed!")
 
@@ -0,0 +1,43 @@
+"""
+Source summary embedding migration
+Adds sources.embedding (centroid of each source's chunks) used to route chat
+retrieval and backfills it for existing sources. Routing ranks one user's
+sources exactly through the user_id index; a global ANN index would filter
+by user only after its scan and could return too few of a user's sources.
+"""
+from sqlalchemy import create_engine, text
+from app.db.connect import get_settings
+
+def add_source_embeddings():
+    """Add and backfill the per-source centroid embedding"""
+    engine = create_engine(get_settings.DATABASE_URL)
+
+    statements = [
+        "ALTER TABLE sources ADD COLUMN IF NOT EXISTS embedding vector(768);",
+        """
+        UPDATE sources SET embedding = centroids.embedding
+        FROM (
+            SELECT source_id, AVG(embedding) AS embedding
+            FROM source_chunks
+            GROUP BY source_id
+        ) AS centroids
+        WHERE sources.id = centroids.source_id AND sources.embedding IS NULL;
+        """,
+        # Created by an earlier version of this migration
+        "DROP INDEX IF EXISTS idx_sources_embedding;",
+    ]
+
+    with engine.connect() as conn:
+        for statement in statements:
+            try:
+                conn.execute(text(statement))
+                conn.commit()
+                print(f"✓ {' '.join(statement.split())[:60]}")
+            except Exception as e:
+                print(f"✗ Failed: {e}")
+                conn.rollback()
+
+    print("\nSource embedding migration completed!")
+
+if __name__ == "__main__":
+    add_source_embeddings()
@@ -0,0 +1,60 @@
+"""
+Source chunk partitioning migration
+Rebuilds source_chunks hash partitioned by user, with user_id copied from
+sources, so chat retrieval filters on the chunk row and scans one partition.
+Runs in a single transaction; take a backup and stop writers first.
+"""
+from sqlalchemy import create_engine, text
+from app.db.connect import get_settings
+from app.db.models import SOURCE_CHUNK_PARTITIONS
+
+def partition_source_chunks():
+    """Move source_chunks into a table partitioned by HASH (user_id)"""
+    engine = create_engine(get_settings.DATABASE_URL)
+
+    statements = [
+        "ALTER TABLE source_chunks RENAME TO source_chunks_unpartitioned;",
+        """
+        CREATE TABLE source_chunks (
+            embedding vector(768),
+            content TEXT NOT NULL,
+            status analysisstatus,
+            id SERIAL NOT NULL,
+            source_id UUID NOT NULL REFERENCES sources(id) ON DELETE CASCADE,
+            user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            PRIMARY KEY (id, user_id)
+        ) PARTITION BY HASH (user_id);
+        """,
+        *[
+            f"CREATE TABLE source_chunks_p{remainder} PARTITION OF source_chunks "
+            f"FOR VALUES WITH (MODULUS {SOURCE_CHUNK_PARTITIONS}, REMAINDER {remainder});"
+            for remainder in range(SOURCE_CHUNK_PARTITIONS)
+        ],
+        """
+        INSERT INTO source_chunks (embedding, content, status, id, source_id, user_id)
+        SELECT c.embedding, c.content, c.status, c.id, c.source_id, s.user_id
+        FROM source_chunks_unpartitioned c
+        JOIN sources s ON s.id = c.source_id;
+        """,
+        "SELECT setval(pg_get_serial_sequence('source_chunks', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM source_chunks;",
+        "DROP TABLE source_chunks_unpartitioned;",
+        # Created on the parent, so every partition gets its own copy. No ANN
+        # index: it would filter by user and source only after its scan and
+        # could return too few chunks, so search ranks the filtered rows exactly
+        "CREATE INDEX IF NOT EXISTS idx_source_chunks_user_id_source_id ON source_chunks(user_id, source_id);",
+        "CREATE INDEX IF NOT EXISTS idx_source_chunks_status ON source_chunks(status);",
+    ]
+
+    try:
+        with engine.begin() as conn:
+            for statement in statements:
+                conn.execute(text(statement))
+                print(f"✓ {' '.join(statement.split())[:60]}")
+    except Exception as e:
+        print(f"✗ Migration failed, nothing was changed: {e}")
+        return
+
+    print("\nSource chunk partitioning completed!")
+
+if __name__ == "__main__":
+    partition_source_chunks()
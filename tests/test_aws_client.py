@@ -0,0 +1,92 @@
+"""
+delete_s3_objects against a moto S3 bucket
+
+Keys S3 refuses are simulated by holding them back from the request and
+reporting them under `Errors`, the way DeleteObjects does for AccessDenied.
+"""
+import boto3
+import pytest
+
+moto = pytest.importorskip("moto")
+
+import app.lib.aws_client as aws
+from app.lib.aws_client import S3_DELETE_BATCH, delete_s3_objects
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=aws.get_settings.AWS_BUCKET_NAME)
+        monkeypatch.setattr(aws, "s3_client", client)
+        yield client
+
+
+@pytest.fixture
+def delete_calls(s3):
+    """Number of keys in each DeleteObjects request."""
+    calls = []
+
+    def record(params, **kwargs):
+        calls.append(len(params["Delete"]["Objects"]))
+
+    s3.meta.events.register("before-parameter-build.s3.DeleteObjects", record)
+    return calls
+
+
+def put_keys(s3, count: int) -> list:
+    keys = [f"user-1/source-{i}.pdf" for i in range(count)]
+    for key in keys:
+        s3.put_object(Bucket=aws.get_settings.AWS_BUCKET_NAME, Key=key, Body=b"x")
+    return keys
+
+
+def remaining_keys(s3) -> set:
+    paginator = s3.get_paginator("list_objects_v2")
+    return {
+        obj["Key"]
+        for page in paginator.paginate(Bucket=aws.get_settings.AWS_BUCKET_NAME)
+        for obj in page.get("Contents", [])
+    }
+
+
+def refuse(s3, protected: set):
+    """Make S3 reject the protected keys with AccessDenied and delete the rest."""
+    def hold_back(params, **kwargs):
+        objects = params["Delete"]["Objects"]
+        params["Delete"]["Objects"] = [obj for obj in objects if obj["Key"] not in protected]
+        kwargs["context"]["refused"] = [obj["Key"] for obj in objects if obj["Key"] in protected]
+
+    def report(parsed, context, **kwargs):
+        parsed["Errors"] = parsed.get("Errors", []) + [
+            {"Key": key, "Code": "AccessDenied", "Message": "Access Denied"}
+            for key in context["refused"]
+        ]
+
+    s3.meta.events.register("before-parameter-build.s3.DeleteObjects", hold_back)
+    s3.meta.events.register("after-call.s3.DeleteObjects", report)
+
+
+def test_more_than_a_batch_of_keys_is_deleted_in_batches(s3, delete_calls):
+    keys = put_keys(s3, 2 * S3_DELETE_BATCH + 500)
+
+    assert delete_s3_objects(keys + [None, ""]) == []
+    assert delete_calls == [S3_DELETE_BATCH, S3_DELETE_BATCH, 500]
+    assert remaining_keys(s3) == set()
+
+
+def test_keys_reported_under_errors_are_returned(s3):
+    keys = put_keys(s3, S3_DELETE_BATCH + 200)
+    protected = {key for key in keys if key.endswith("7.pdf")}
+    refuse(s3, protected)
+
+    assert sorted(delete_s3_objects(keys)) == sorted(protected)
+    assert remaining_keys(s3) == protected
+
+
+def test_a_failed_batch_returns_its_keys_instead_of_raising(s3, delete_calls, monkeypatch):
+    keys = put_keys(s3, S3_DELETE_BATCH + 10)
+    monkeypatch.setattr(aws.get_settings, "AWS_BUCKET_NAME", "missing-bucket")
+
+    assert delete_s3_objects(keys) == keys
+    assert delete_calls == [S3_DELETE_BATCH, 10]
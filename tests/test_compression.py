@@ -0,0 +1,75 @@
+"""
+CompressionMiddleware on single and streamed responses
+"""
+import asyncio
+import pytest
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from app.lib.compression import AVAILABLE_ENCODINGS, MINIMUM_SIZE, CompressionMiddleware, decompress
+
+BODY = b"".join(b"line %d of a compressible body\n" % i for i in range(200))
+
+
+def request(app, accept_encoding: str = None):
+    """Raw (status, headers, body) of one GET through CompressionMiddleware."""
+    messages = []
+    headers = [(b"accept-encoding", accept_encoding.encode())] if accept_encoding else []
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": headers, "query_string": b""}
+
+    requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        # The client stays connected until the response is done
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(CompressionMiddleware(app)(scope, receive, send))
+    start, bodies = messages[0], messages[1:]
+    response_headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    return start["status"], response_headers, b"".join(m.get("body", b"") for m in bodies)
+
+
+def streamed(chunks, media_type="application/x-ndjson"):
+    async def generate():
+        for chunk in chunks:
+            yield chunk
+
+    return StreamingResponse(generate(), media_type=media_type)
+
+
+@pytest.mark.parametrize("encoding", AVAILABLE_ENCODINGS)
+def test_single_body_is_compressed_with_the_negotiated_encoding(encoding):
+    status, headers, body = request(PlainTextResponse(BODY), f"{encoding}, identity;q=0.5")
+    assert status == 200
+    assert headers["content-encoding"] == encoding
+    assert headers["content-length"] == str(len(body))
+    assert headers["vary"] == "Accept-Encoding"
+    assert decompress(body, encoding) == BODY
+
+
+@pytest.mark.parametrize("encoding", AVAILABLE_ENCODINGS)
+def test_streamed_body_is_compressed_chunk_by_chunk(encoding):
+    chunks = [BODY[i:i + 700] for i in range(0, len(BODY), 700)]
+    status, headers, body = request(streamed(chunks), encoding)
+    assert headers["content-encoding"] == encoding
+    assert "content-length" not in headers
+    assert decompress(body, encoding) == BODY
+
+
+def test_small_bodies_and_identity_clients_are_left_alone():
+    _, headers, body = request(PlainTextResponse(b"x" * (MINIMUM_SIZE - 1)), "gzip")
+    assert "content-encoding" not in headers and body == b"x" * (MINIMUM_SIZE - 1)
+    _, headers, body = request(PlainTextResponse(BODY))
+    assert "content-encoding" not in headers and body == BODY
+    assert headers["vary"] == "Accept-Encoding"
+
+
+def test_encoded_bodies_and_event_streams_pass_through():
+    encoded = Response(b"already encoded" * 100, headers={"Content-Encoding": "br"})
+    _, headers, body = request(encoded, "gzip")
+    assert headers["content-encoding"] == "br" and body == b"already encoded" * 100
+    _, headers, body = request(streamed([BODY], media_type="text/event-stream"), "gzip")
+    assert "content-encoding" not in headers and body == BODY
@@ -0,0 +1,177 @@
+"""
+AdaptiveConcurrencyLimiter under simulated load
+
+Calls run against a simulated clock, so each scenario covers thousands of
+calls deterministically and in milliseconds.
+"""
+import heapq
+import random
+import asyncio
+from itertools import count
+import pytest
+import app.lib.concurrency_limit as concurrency_limit
+from app.lib.concurrency_limit import AdaptiveConcurrencyLimiter, ConcurrencyLimitExceeded
+
+
+class SimClock:
+    """Replaces ``monotonic``; ``sleep`` only finishes when ``run`` reaches it."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._timers = []
+        self._seq = count()
+
+    def __call__(self) -> float:
+        return self.now
+
+    def at(self, when: float, callback):
+        heapq.heappush(self._timers, (when, next(self._seq), callback))
+
+    def sleep(self, seconds: float):
+        future = asyncio.get_running_loop().create_future()
+        self.at(self.now + seconds, lambda: future.done() or future.set_result(None))
+        return future
+
+    async def run(self, until: float):
+        while True:
+            for _ in range(10):
+                await asyncio.sleep(0)
+            if not self._timers or self._timers[0][0] > until:
+                return
+            self.now, _, callback = heapq.heappop(self._timers)
+            callback()
+
+
+class SimServer:
+    """Latency drawn from `sample`, stretched once more than `capacity` calls are in flight."""
+
+    def __init__(self, clock: SimClock, sample, capacity: float = float("inf")):
+        self.clock = clock
+        self.sample = sample
+        self.capacity = capacity
+        self.in_flight = 0
+
+    async def call(self):
+        self.in_flight += 1
+        try:
+            await self.clock.sleep(self.sample() * max(1.0, self.in_flight / self.capacity))
+        finally:
+            self.in_flight -= 1
+
+
+def simulate(limiter, server, clock, users: int, duration: float, ramp: float = 0.0):
+    """
+    Closed-loop users calling through the limiter, arriving evenly over `ramp`
+    seconds; returns (ok latencies, rejections, lowest limit).
+    """
+    latencies, rejected, lowest = [], 0, [limiter.limit]
+
+    async def user(arrival: float):
+        nonlocal rejected
+        await clock.sleep(arrival)
+        while clock.now < duration:
+            started = clock.now
+            try:
+                async with limiter.slot():
+                    await server.call()
+                latencies.append(clock.now - started)
+            except ConcurrencyLimitExceeded:
+                rejected += 1
+                await clock.sleep(0.05)
+            lowest[0] = min(lowest[0], limiter.limit)
+
+    async def main():
+        tasks = [asyncio.create_task(user(ramp * i / users)) for i in range(users)]
+        await clock.run(duration + 60)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    return latencies, rejected, lowest[0]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimClock()
+    monkeypatch.setattr(concurrency_limit, "monotonic", clock)
+    return clock
+
+
+def test_generation_length_variance_is_not_overload(clock):
+    # Latency follows answer length, not load: the server never slows down
+    rng = random.Random(1)
+    limiter = AdaptiveConcurrencyLimiter("generate", initial_limit=16, max_limit=128)
+    server = SimServer(clock, lambda: rng.uniform(0.02, 0.2))
+    latencies, rejected, lowest = simulate(limiter, server, clock, users=6, duration=10)
+    assert len(latencies) > 240
+    assert rejected == 0
+    assert lowest >= 16
+
+
+def test_slow_tail_does_not_shrink_the_limit(clock):
+    # Embedding calls: mostly 10ms, 6% take 100ms; enough users to use the limit
+    rng = random.Random(2)
+    limiter = AdaptiveConcurrencyLimiter("vector", initial_limit=16, max_limit=128)
+    server = SimServer(clock, lambda: 0.1 if rng.random() < 0.06 else 0.01)
+    latencies, rejected, lowest = simulate(limiter, server, clock, users=12, duration=5)
+    assert len(latencies) > 1000
+    assert rejected == 0
+    assert lowest >= 16
+
+
+def test_queueing_caps_the_limit(clock):
+    # 8 calls at a time run at 50ms; beyond that every call slows down in
+    # proportion. 64 users arrive over 5s, far more than the server can take
+    rng = random.Random(3)
+    limiter = AdaptiveConcurrencyLimiter("queueing", initial_limit=16, max_limit=128)
+    server = SimServer(clock, lambda: rng.uniform(0.045, 0.055), capacity=8)
+    latencies, rejected, _ = simulate(limiter, server, clock, users=64, duration=30, ramp=5)
+    assert limiter.limit <= 32
+    assert rejected > 0
+    # Admitted calls stay close to the unloaded latency instead of the 8x an
+    # unlimited 64-way queue would cause
+    recent = sorted(latencies[len(latencies) // 2:])
+    assert recent[len(recent) // 2] < 0.05 * 3
+
+
+def test_degraded_server_shrinks_the_limit(clock):
+    # A healthy server loses most of its capacity 10s in
+    rng = random.Random(4)
+    limiter = AdaptiveConcurrencyLimiter("degrading", initial_limit=16, max_limit=128)
+    server = SimServer(clock, lambda: rng.uniform(0.045, 0.055), capacity=64)
+    healthy = []
+    clock.at(9.9, lambda: healthy.append(limiter.limit))
+    clock.at(10, lambda: setattr(server, "capacity", 8))
+    latencies, _, _ = simulate(limiter, server, clock, users=64, duration=40)
+    assert healthy == [128]
+    assert limiter.limit <= 32
+    recent = sorted(latencies[-1000:])
+    assert recent[len(recent) // 2] < 0.05 * 3
+
+
+def test_cancelled_calls_are_not_measured(clock):
+    limiter = AdaptiveConcurrencyLimiter("cancel", initial_limit=16)
+    server = SimServer(clock, lambda: 0.2)
+
+    async def main():
+        for _ in range(30):
+            async with limiter.slot():
+                task = asyncio.create_task(server.call())
+                await clock.run(clock.now + 1)
+                await task
+        before = limiter.stats()
+
+        async def cancelled_call():
+            async with limiter.slot():
+                await clock.sleep(1)
+
+        task = asyncio.create_task(cancelled_call())
+        await clock.run(clock.now + 0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return before, limiter.stats()
+
+    before, after = asyncio.run(main())
+    assert after == before
+    assert after["in_flight"] == 0
+    assert after["baseline_ms"] == pytest.approx(200, rel=0.01)
@@ -0,0 +1,121 @@
+"""
+EmbeddingCoalescer batching, fan-out and fallback
+
+The ML calls are replaced with fakes that record what was sent.
+"""
+import asyncio
+import httpx
+import pytest
+import app.services.ml_process as ml_process
+from app.services.ml_process import EmbeddingCoalescer
+
+
+def vector_for(text: str) -> list:
+    return [float(len(text)), float(ord(text[0]))]
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    """Texts of each /get-vectors call; vectors depend on the text, so mix-ups show."""
+    sent = []
+
+    async def post(self, texts):
+        sent.append(list(texts))
+        await asyncio.sleep(0)
+        return [vector_for(text) for text in texts]
+
+    monkeypatch.setattr(EmbeddingCoalescer, "_post", post)
+    return sent
+
+
+def test_concurrent_callers_share_a_batch_and_get_their_own_vectors(batches):
+    coalescer = EmbeddingCoalescer(max_batch_size=16, max_wait=0.01)
+    texts = ["a", "bb", "ccc", "dddd"]
+
+    async def main():
+        return await asyncio.gather(*(coalescer.embed(text) for text in texts))
+
+    assert asyncio.run(main()) == [vector_for(text) for text in texts]
+    assert batches == [texts]
+
+
+def test_full_batches_are_sent_without_waiting(batches):
+    coalescer = EmbeddingCoalescer(max_batch_size=3, max_wait=60)
+    texts = ["a", "b", "c", "d", "e", "f"]
+
+    async def main():
+        return await asyncio.wait_for(asyncio.gather(*(coalescer.embed(text) for text in texts)), 1)
+
+    assert asyncio.run(main()) == [vector_for(text) for text in texts]
+    assert batches == [["a", "b", "c"], ["d", "e", "f"]]
+
+
+def test_a_failed_batch_fails_only_its_callers(monkeypatch):
+    async def post(self, texts):
+        if "bad" in texts:
+            raise RuntimeError("ML server error")
+        return [vector_for(text) for text in texts]
+
+    monkeypatch.setattr(EmbeddingCoalescer, "_post", post)
+    coalescer = EmbeddingCoalescer(max_batch_size=2, max_wait=0.01)
+
+    async def main():
+        return await asyncio.gather(
+            *(coalescer.embed(text) for text in ["bad", "x", "good", "y"]), return_exceptions=True
+        )
+
+    first, second, third, fourth = asyncio.run(main())
+    assert isinstance(first, RuntimeError) and isinstance(second, RuntimeError)
+    assert (third, fourth) == (vector_for("good"), vector_for("y"))
+
+
+def test_a_short_response_fails_the_batch(monkeypatch):
+    async def post(self, texts):
+        return [vector_for(texts[0])]
+
+    monkeypatch.setattr(EmbeddingCoalescer, "_post", post)
+    coalescer = EmbeddingCoalescer(max_batch_size=16, max_wait=0.01)
+
+    async def main():
+        return await asyncio.gather(*(coalescer.embed(text) for text in ["a", "b"]), return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(main()))
+
+
+def test_cancelled_callers_are_left_out_of_the_batch(batches):
+    coalescer = EmbeddingCoalescer(max_batch_size=16, max_wait=0.01)
+
+    async def main():
+        tasks = {text: asyncio.create_task(coalescer.embed(text)) for text in ["keep", "gone", "also"]}
+        await asyncio.sleep(0)
+        tasks["gone"].cancel()
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        return dict(zip(tasks, results))
+
+    results = asyncio.run(main())
+    assert isinstance(results["gone"], asyncio.CancelledError)
+    assert results["keep"] == vector_for("keep") and results["also"] == vector_for("also")
+    assert batches == [["keep", "also"]]
+
+
+def test_missing_batch_endpoint_falls_back_to_single_calls(monkeypatch):
+    async def post(self, texts):
+        request = httpx.Request("POST", "http://ml/get-vectors")
+        raise httpx.HTTPStatusError("Not Found", request=request, response=httpx.Response(404, request=request))
+
+    singles = []
+
+    async def post_vector(client, text):
+        singles.append(text)
+        return vector_for(text)
+
+    monkeypatch.setattr(EmbeddingCoalescer, "_post", post)
+    monkeypatch.setattr(ml_process, "_post_vector", post_vector)
+    coalescer = EmbeddingCoalescer(max_batch_size=16, max_wait=0.01)
+
+    async def main():
+        return await asyncio.gather(*(coalescer.embed(text) for text in ["a", "bb"]))
+
+    assert asyncio.run(main()) == [vector_for("a"), vector_for("bb")]
+    assert sorted(singles) == ["a", "bb"]
+    assert not coalescer.enabled
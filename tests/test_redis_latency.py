@@ -0,0 +1,171 @@
+"""
+Cache and rate limiter behaviour when Redis is slow or down
+
+Redis is a fakeredis server behind a TCP proxy that can delay traffic or
+drop it, so the real client, pool and socket timeouts are exercised.
+"""
+import asyncio
+import threading
+from time import perf_counter
+import pytest
+import redis
+from fakeredis import TcpFakeServer
+from app.lib import cache, redis_pool
+from app.lib.rate_limit import _GCRA_LUA, _SLIDING_WINDOW_LUA, GCRA, SLIDING_WINDOW, RateLimiter
+
+SOCKET_TIMEOUT = 0.05
+# Every call must come back within a few socket timeouts, however slow Redis is
+LATENCY_BOUND = 4 * SOCKET_TIMEOUT
+
+
+class RedisProxy:
+    """Forwards to `upstream`, holding each client chunk for `delay` seconds."""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.delay = 0.0
+        self._server = None
+        self._writers = []
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return "redis://127.0.0.1:%d/0" % self._server.sockets[0].getsockname()[1]
+
+    async def down(self):
+        """Refuse new connections and drop the open ones."""
+        self._server.close()
+        await self._server.wait_closed()
+        for writer in self._writers:
+            writer.close()
+
+    async def _handle(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(*self.upstream)
+        self._writers += [client_writer, server_writer]
+
+        async def pipe(reader, writer, delayed):
+            try:
+                while data := await reader.read(65536):
+                    if delayed and self.delay:
+                        await asyncio.sleep(self.delay)
+                    writer.write(data)
+                    await writer.drain()
+            except (ConnectionError, OSError):
+                pass
+            finally:
+                writer.close()
+
+        await asyncio.gather(
+            pipe(client_reader, server_writer, True), pipe(server_reader, client_writer, False)
+        )
+
+
+@pytest.fixture
+def fake_redis():
+    server = TcpFakeServer(("127.0.0.1", 0))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # fakeredis drops the connection after a NOSCRIPT reply, which real Redis
+    # doesn't; load the scripts up front so EVALSHA finds them
+    with redis.Redis(*server.server_address) as client:
+        client.script_load(_GCRA_LUA)
+        client.script_load(_SLIDING_WINDOW_LUA)
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def run(fake_redis, monkeypatch):
+    """Run a scenario against the proxied Redis, with the shared pool opened on it."""
+    monkeypatch.setattr(redis_pool.get_settings, "REDIS_SOCKET_TIMEOUT", SOCKET_TIMEOUT)
+    monkeypatch.setattr(redis_pool.get_settings, "REDIS_CONNECT_TIMEOUT", SOCKET_TIMEOUT)
+    cache._near_cache.clear()
+
+    def run(scenario):
+        async def main():
+            proxy = RedisProxy(fake_redis)
+            monkeypatch.setattr(redis_pool.get_settings, "REDIS_URL", await proxy.start())
+            assert await redis_pool.init_redis()
+            try:
+                return await scenario(proxy)
+            finally:
+                await redis_pool.close_redis()
+
+        return asyncio.run(main())
+
+    yield run
+    cache._near_cache.clear()
+
+
+async def timed(calls):
+    """Results of awaiting each call in turn, and the p99 of their latencies."""
+    results, latencies = [], []
+    for call in calls:
+        started = perf_counter()
+        results.append(await call())
+        latencies.append(perf_counter() - started)
+    latencies.sort()
+    return results, latencies[int(len(latencies) * 0.99) - 1]
+
+
+@pytest.mark.parametrize("delay", [0.01, 0.5])
+def test_cache_on_slow_redis(run, delay):
+    async def scenario(proxy):
+        assert await cache.set("cached", {"answer": 42})
+        proxy.delay = delay
+        results, p99 = await timed([lambda: cache.get("cached")] * 20)
+        # Served from the near cache without waiting on Redis
+        assert results == [{"answer": 42}] * 20
+        assert p99 < 0.005
+
+        stored, p99 = await timed([lambda i=i: cache.set(f"key:{i}", i) for i in range(20)])
+        assert p99 < LATENCY_BOUND
+        found, p99 = await timed([lambda i=i: cache.get(f"missing:{i}") for i in range(20)])
+        assert p99 < LATENCY_BOUND
+        assert found == [None] * 20
+        return stored
+
+    stored = run(scenario)
+    # Under the socket timeout writes go through; over it they fail instead of hanging
+    assert stored == ([True] * 20 if delay < SOCKET_TIMEOUT else [False] * 20)
+
+
+def test_cache_on_redis_going_down(run):
+    async def scenario(proxy):
+        assert await cache.set("cached", "value")
+        await proxy.down()
+        stored, set_p99 = await timed([lambda i=i: cache.set(f"key:{i}", i) for i in range(20)])
+        found, get_p99 = await timed([lambda i=i: cache.get(f"key:{i}") for i in range(20)])
+        loaded = await cache.get_or_load("loaded", lambda: "from loader", ttl=60)
+        assert await cache.get("cached") == "value"
+        return stored, set_p99, found, get_p99, loaded
+
+    stored, set_p99, found, get_p99, loaded = run(scenario)
+    assert stored == [False] * 20
+    assert found == [None] * 20
+    assert loaded == "from loader"
+    assert set_p99 < LATENCY_BOUND
+    assert get_p99 < LATENCY_BOUND
+
+
+@pytest.mark.parametrize("algorithm", [GCRA, SLIDING_WINDOW])
+@pytest.mark.parametrize("failure", ["slow", "down"])
+def test_rate_limiter_falls_back_to_local_limits(run, algorithm, failure):
+    limiter = RateLimiter(algorithm)
+
+    async def scenario(proxy):
+        # Counted in Redis while it is healthy
+        first = await limiter.hit("user:1", calls=10, period=60)
+        if failure == "slow":
+            proxy.delay = 0.5
+        else:
+            await proxy.down()
+        return first, await timed([lambda: limiter.hit("user:1", calls=10, period=60)] * 15)
+
+    first, (results, p99) = run(scenario)
+    assert first.allowed and first.remaining == 9
+    assert p99 < LATENCY_BOUND
+    # The in-process store still enforces the budget on its own
+    assert [r.allowed for r in results] == [True] * 10 + [False] * 5
+    assert results[-1].retry_after > 0
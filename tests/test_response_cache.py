@@ -0,0 +1,178 @@
+"""
+cache_response on the list routes
+
+Runs the real routes on SQLite with a fakeredis-backed cache and counts the
+SQL each request issues.
+"""
+import uuid
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+import fakeredis
+from fastapi.testclient import TestClient
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import app.main as main
+from app.lib import cache
+from app.db.models import AnalysisStatus, ChatMessage, Conversation, Source, User
+from app.db.schemas import PrincipalSchema
+
+
+@compiles(JSONB, "sqlite")
+def _jsonb_on_sqlite(type_, compiler, **kw):
+    return "JSON"
+
+
+@compiles(Vector, "sqlite")
+def _vector_on_sqlite(type_, compiler, **kw):
+    return "TEXT"
+
+
+USER_ID = uuid.uuid4()
+CONVERSATION_ID = uuid.uuid4()
+LIST_ROUTES = ["/get-sources", "/conversations", f"/conversations/{CONVERSATION_ID}/messages"]
+
+
+@pytest.fixture
+def queries():
+    """SQL statements run so far; the app's sessions use this database."""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    tables = [model.__table__ for model in (User, Source, Conversation, ChatMessage)]
+    User.metadata.create_all(engine, tables=tables)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    start = datetime(2026, 1, 1)
+    with Session() as db:
+        db.add(User(id=USER_ID, email="user@example.com", hashed_password="x"))
+        db.flush()
+        db.add(Conversation(id=CONVERSATION_ID, user_id=USER_ID, title="first", created_at=start))
+        db.add_all([
+            Conversation(user_id=USER_ID, title=f"chat {i}", created_at=start + timedelta(minutes=i + 1))
+            for i in range(60)
+        ])
+        db.add_all([
+            ChatMessage(conversation_id=CONVERSATION_ID, role="user", content=f"message {i} " * 20,
+                        created_at=start + timedelta(seconds=i))
+            for i in range(60)
+        ])
+        db.add_all([
+            Source(user_id=USER_ID, source_name=f"source {i}", source_type="video", unique_key=f"key-{i}",
+                   status=AnalysisStatus.COMPLETED, created_at=start + timedelta(minutes=i))
+            for i in range(60)
+        ])
+        db.commit()
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+
+    def get_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    main.app.dependency_overrides[main.get_db] = get_db
+    main.app.dependency_overrides[main.get_current_user] = lambda: PrincipalSchema(
+        id=USER_ID, email="user@example.com", credits=5
+    )
+    yield statements
+    main.app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def client(queries, monkeypatch):
+    # TestClient runs each request on its own event loop; fakeredis clients
+    # are bound to one, so every loop gets a client on the same server
+    server = fakeredis.FakeServer()
+    clients = {}
+
+    def get_redis():
+        loop = asyncio.get_running_loop()
+        if loop not in clients:
+            clients[loop] = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+        return clients[loop]
+
+    monkeypatch.setattr(cache, "get_redis", get_redis)
+    cache._near_cache.clear()
+    yield TestClient(main.app)
+    cache._near_cache.clear()
+
+
+@pytest.mark.parametrize("path", LIST_ROUTES)
+@pytest.mark.parametrize("accept_encoding", ["gzip", "identity"])
+def test_hit_skips_the_database_and_returns_the_same_response(client, queries, path, accept_encoding):
+    headers = {"Accept-Encoding": accept_encoding}
+    miss = client.get(path, headers=headers)
+    assert miss.status_code == 200
+    assert queries
+
+    queries.clear()
+    near_hit = client.get(path, headers=headers)
+    # Past the near cache, so the body comes back out of Redis
+    cache._near_cache.clear()
+    redis_hit = client.get(path, headers=headers)
+    assert queries == []
+
+    for hit in (near_hit, redis_hit):
+        assert hit.status_code == 200
+        assert hit.content == miss.content
+        assert hit.headers["content-type"] == "application/json"
+        assert hit.headers.get("content-encoding") == miss.headers.get("content-encoding")
+        assert hit.headers["x-next-cursor"] == miss.headers["x-next-cursor"]
+        if path != LIST_ROUTES[2]:
+            assert hit.headers["etag"] == miss.headers["etag"]
+
+
+def test_pages_are_cached_separately(client, queries):
+    first = client.get("/conversations")
+    second = client.get("/conversations", params={"cursor": first.headers["x-next-cursor"]})
+    assert second.status_code == 200
+    assert {c["id"] for c in first.json()}.isdisjoint(c["id"] for c in second.json())
+    assert len(first.json()) + len(second.json()) == 61
+
+
+@pytest.mark.parametrize("path", LIST_ROUTES)
+def test_invalidate_tag_forces_a_reload(client, queries, path):
+    before = client.get(path)
+    queries.clear()
+    asyncio.run(cache.invalidate_tag(f"user:{USER_ID}"))
+    after = client.get(path)
+    assert queries
+    assert after.content == before.content
+    if path != LIST_ROUTES[2]:
+        assert after.headers["etag"] != before.headers["etag"]
+
+
+def test_conversation_tag_reloads_only_its_messages(client, queries):
+    client.get("/conversations")
+    client.get(LIST_ROUTES[2])
+    asyncio.run(cache.invalidate_tag(f"conversation:{CONVERSATION_ID}"))
+    queries.clear()
+    client.get("/conversations")
+    assert queries == []
+    client.get(LIST_ROUTES[2])
+    assert queries
+
+
+def test_not_found_is_not_cached(client, queries):
+    path = f"/conversations/{uuid.uuid4()}/messages"
+    assert client.get(path).status_code == 404
+    queries.clear()
+    assert client.get(path).status_code == 404
+    assert queries
+
+
+def test_errors_are_not_cached(client, queries, monkeypatch):
+    def failing_paginate(*args, **kwargs):
+        raise RuntimeError("database unavailable")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(main, "paginate", failing_paginate)
+        assert client.get("/get-sources").status_code == 500
+    response = client.get("/get-sources")
+    assert response.status_code == 200
+    assert len(response.json()) == 50